@@ -1,15 +1,166 @@
 
+import time
+_import_started = time.perf_counter()
+
 import argparse
 import collections
 import datetime
 import functools
+import importlib
 import itertools
+import logging
 import random
 import struct
-import time
-import xml
-from asteroid import bleee
-from gi.repository import GLib
+import weakref
+from asteroid import bleee, metrics
+from asteroid.scheduler import QueueFull, WriteScheduler
+from asteroid.timeseries import SampleRing
+from gi.repository import Gio, GLib
+
+
+logger = logging.getLogger(__name__)
+
+# How long importing the package (and with it GLib and pydbus) took
+import_seconds = time.perf_counter() - _import_started
+
+
+class LazyModule:
+    """
+    Stands in for an optional dependency, which is only imported once an
+    attribute is accessed (or _load() is called)
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+
+def call_soon(fn, *args):
+    """ Calls fn from the event loop, exactly once """
+    def cb():
+        fn(*args)
+        return False
+    GLib.idle_add(cb)
+
+
+# Maximum length of an attribute value, bigger writes fail
+ATT_MAX_VALUE_LEN = 512
+
+
+def _xml_escape(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def _truncate_escaped(text, max_len):
+    """
+    Returns the longest prefix of text (with an ellipsis if cut) whose escaped
+    UTF-8 form fits into max_len bytes. Cutting the unescaped text makes sure
+    that no character or entity gets split.
+    """
+    encoded = _xml_escape(text).encode()
+    if len(encoded) <= max_len:
+        return encoded
+    ellipsis = "\u2026".encode()
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if len(_xml_escape(text[:mid]).encode()) + len(ellipsis) <= max_len:
+            lo = mid
+        else:
+            hi = mid - 1
+    if lo == 0 and len(ellipsis) > max_len:
+        return b""
+    return _xml_escape(text[:lo]).encode() + ellipsis
+
+
+def encode_time(to):
+    return bytes([
+        to.year - 1900,
+        to.month - 1,
+        to.day,
+        to.hour,
+        to.minute,
+        to.second
+    ])
+
+
+def encode_notification(summary, body, id_, package_name, app_name, app_icon,
+                        max_len=ATT_MAX_VALUE_LEN):
+    """
+    Encodes a notification for the watch into at most max_len bytes. If it
+    does not fit, the app icon and package name are dropped first, then the
+    body, the summary and the app name are truncated. Budgets too small for
+    even that lose the id and the summary, ValueError is raised if the bare
+    <insert></insert> does not fit either.
+    """
+    fields = [["su", summary], ["bo", body], ["id", id_],
+              ["pn", package_name], ["an", app_name], ["ai", app_icon]]
+    parts = {n: _xml_escape(v).encode() for n, v in fields if v is not None}
+
+    def size():
+        # <insert></insert> plus <xx></xx> around every field
+        return 17 + sum(9 + len(v) for v in parts.values())
+
+    for optional in ("ai", "pn"):
+        if size() <= max_len:
+            break
+        parts.pop(optional, None)
+    for name, text in (("bo", body), ("su", summary), ("an", app_name)):
+        over = size() - max_len
+        if over <= 0 or name not in parts:
+            continue
+        parts[name] = _truncate_escaped(text, max(len(parts[name]) - over, 0))
+        if not parts[name] and name != "su":
+            del parts[name]
+    for name in ("id", "su"):
+        if size() > max_len:
+            parts.pop(name, None)
+    if size() > max_len:
+        raise ValueError("No notification fits into %d bytes" % max_len)
+    ret = b"<insert>" + b"".join(
+        b"<" + n.encode() + b">" + parts[n] + b"</" + n.encode() + b">"
+        for n, _ in fields if n in parts) + b"</insert>"
+    assert len(ret) <= max_len
+    return ret
+
+
+class _WriteGroup:
+    """
+    Tracks the writes which make up one update. callback is called once all
+    of them went through, error_callback with the first error otherwise.
+    """
+
+    def __init__(self, callback=None, error_callback=None):
+        self.callback = callback
+        self.error_callback = error_callback
+        self._pending = 1
+        self._failed = False
+
+    def add(self):
+        self._pending += 1
+        return {"callback": self._done, "error_callback": self._error}
+
+    def close(self):
+        self._done()
+
+    def _done(self):
+        self._pending -= 1
+        if not self._pending and not self._failed and self.callback:
+            self.callback()
+
+    def _error(self, e):
+        if not self._failed:
+            self._failed = True
+            if self.error_callback:
+                self.error_callback(e)
 
 
 def ensure_connected(fn):
@@ -19,7 +170,7 @@ def ensure_connected(fn):
         # device can disconnect at any time
         self.connect()
         ret = fn(self, *args, **kwargs)
-        # Do we want to schedule a disconnect? Or is BLE low power enough?
+        self._touch()
         return ret
     return wrapper
 
@@ -40,6 +191,17 @@ class WeatherPredictions:
         self.values.append(WeatherPredictions.Prediction(
                                     id_=id_, min_=min_, max_=max_))
 
+    def to_dict(self):
+        return {"city_name": self.city_name,
+                "values": [list(v) for v in self.values]}
+
+    @classmethod
+    def from_dict(class_, dict_):
+        ret = class_(dict_["city_name"])
+        for id_, min_, max_ in dict_["values"]:
+            ret.append_prediction(id_, min_, max_)
+        return ret
+
     @classmethod
     def from_owm(class_, owmforecast):
         # We will get None if the name is no
@@ -78,125 +240,773 @@ class Asteroid:
     MEDIA_COMMAND_PLAY = 0x2
     MEDIA_COMMAND_PAUSE = 0x3
 
-    def __init__(self, address):
-        self.ble = bleee.BLE()
+    _instances = weakref.WeakValueDictionary()
+
+    def __init__(self, address, ble=None, journal=None):
         self.address = address
-        self.dev = self.ble.device_by_address(self.address)
+        # Both looked up on first use
+        self._ble = ble
+        self._dev = None
+        # Seconds without writes after which we disconnect, None for never
         self.disconnect_timeout = None
         self._disconnect_id = None
+        # Set while we are disconnected for being idle. The first write after
+        # that waits batch_window seconds before connecting, so that one
+        # connection setup serves all the updates which pile up meanwhile.
+        self.idle_disconnected = False
+        self.batch_window = 0.5
+        self._wake_id = None
+        self._wake_waiters = []
+        self._created = time.monotonic()
+        self._sessions = collections.Counter()
+        self._connecting = False
+        self._connect_started = None
+        self._connect_waiters = []
+        # Seconds connect_async waits for the services to be resolved
+        self.connect_timeout = 30
+        self._connect_timeout_id = None
+        # Writes waiting for the connection to come back
+        self._link_waiters = []
+        self._connected_since = None
+        Asteroid._instances[address] = self
+        uptime_gauge.track(address=address)
+        duty_cycle_gauge.track(address=address)
+        # Last value written to each characteristic, as far as we know
+        self._shadow = {}
+        self.scheduler = WriteScheduler(self._write_raw)
+        # Writes made while the watch is away go here, if set
+        self.journal = journal
+        self.screenshot_stats = None
+        # Notifications are cut down to fit into this many ATT packets, unless
+        # notify_max_bytes is set
+        self.notify_max_packets = 8
+        self.notify_max_bytes = None
+        # Kept up to date from battery notifications
+        self._battery_level = None
+        self._battery_subscription = None
+        self.battery_history = SampleRing()
+        battery_gauge.track(address=address)
+
+    @property
+    def ble(self):
+        if self._ble is None:
+            self._ble = bleee.BLE()
+        return self._ble
+
+    @property
+    def dev(self):
+        """ The BLEDevice, raises IOError if BlueZ does not know the watch """
+        if self._dev is None:
+            dev = self.ble.device_by_address(self.address)
+            if dev.connected:
+                self._connected_since = time.monotonic()
+            dev.properties_changed.connect(self._dev_properties_changed)
+            self._dev = dev
+            if dev.connected:
+                # Whatever a previous run journaled would otherwise wait
+                # for the next reconnect
+                call_soon(self.replay_journal)
+            if dev.services_resolved:
+                call_soon(self._watch_battery)
+        return self._dev
+
+    @property
+    def uptime(self):
+        """ Seconds since the current connection was established """
+        if self._connected_since is None:
+            return 0.0
+        return time.monotonic() - self._connected_since
+
+    def _dev_properties_changed(self, name, changed, lst):
+        if not changed.get("Connected", True):
+            if self._connected_since is not None:
+                self._sessions["sessions"] += 1
+                self._sessions["connected_time"] += \
+                    time.monotonic() - self._connected_since
+            self._connected_since = None
+            self._cancel_idle()
+            if self._connect_waiters:
+                # The link dropped before the services got resolved
+                self._connect_finished(
+                    IOError("Lost the connection to %s" % self.address))
+            # The watch does not have to keep its state over reconnects
+            self.forget_shadow()
+            if self.journal is not None:
+                # Pending writes fail into the journal
+                self.scheduler.clear()
+        elif changed.get("Connected", False):
+            self._connected_since = time.monotonic()
+            self.idle_disconnected = False
+            self._touch()
+            self.replay_journal()
+        if changed.get("ServicesResolved", False):
+            self._connect_finished(None)
+            waiters, self._link_waiters = self._link_waiters, []
+            for fn in waiters:
+                fn()
+            self._watch_battery()
+
+    def _connect_finished(self, error):
+        self._connecting = False
+        if self._connect_timeout_id is not None:
+            GLib.source_remove(self._connect_timeout_id)
+            self._connect_timeout_id = None
+        if self._connect_started is not None:
+            if error is None:
+                metrics.connect_seconds.observe(
+                    time.monotonic() - self._connect_started,
+                    address=self.address)
+            else:
+                metrics.connect_errors.inc(address=self.address)
+            self._connect_started = None
+        waiters, self._connect_waiters = self._connect_waiters, []
+        for callback, error_callback in waiters:
+            if error is None and callback:
+                callback()
+            elif error is not None and error_callback:
+                error_callback(error)
+
+    def _connect_reply(self):
+        # ServicesResolved may have been signalled before the reply arrived
+        if self.dev.services_resolved:
+            self._connect_finished(None)
+
+    def _connect_timed_out(self):
+        self._connect_timeout_id = None
+        self._connect_finished(IOError("Connecting to %s timed out after %d s"
+                                       % (self.address, self.connect_timeout)))
+        return False
+
+    def connect_async(self, callback=None, error_callback=None):
+        """
+        Connects without blocking the event loop. callback is called once the
+        services are resolved, error_callback with the GLib.Error if the
+        attempt fails, or with an IOError if the link drops or the services
+        are not resolved within connect_timeout seconds.
+        """
+        if self.dev.connected and self.dev.services_resolved:
+            if callback:
+                call_soon(callback)
+            return
+        self._connect_waiters.append((callback, error_callback))
+        if self._connect_timeout_id is None:
+            self._connect_timeout_id = GLib.timeout_add(
+                int(self.connect_timeout * 1000), self._connect_timed_out)
+        if not self._connecting and not self.dev.connected:
+            self._connecting = True
+            self._connect_started = time.monotonic()
+            metrics.connect_attempts.inc(address=self.address)
+            self.dev.connect_async(callback=self._connect_reply,
+                                   error_callback=self._connect_finished)
+
+    def _wake(self, callback=None, error_callback=None):
+        # Connects, after the batching window if we went idle before
+        if not self.idle_disconnected or not self.batch_window:
+            self.connect_async(callback, error_callback)
+            return
+        self._wake_waiters.append((callback, error_callback))
+        if self._wake_id is None:
+            self._wake_id = GLib.timeout_add(int(self.batch_window * 1000),
+                                             self._wake_up)
+
+    def _wake_up(self):
+        self._wake_id = None
+        waiters, self._wake_waiters = self._wake_waiters, []
+        for callback, error_callback in waiters:
+            self.connect_async(callback, error_callback)
+        return False
+
+    def _touch(self):
+        """ Restarts the idle disconnect timer """
+        self._cancel_idle()
+        if self.disconnect_timeout is not None and \
+                self._connected_since is not None:
+            self._disconnect_id = GLib.timeout_add(
+                int(self.disconnect_timeout * 1000), self._idle_timeout)
+
+    def _cancel_idle(self):
+        if self._disconnect_id is not None:
+            GLib.source_remove(self._disconnect_id)
+            self._disconnect_id = None
+
+    def _idle_timeout(self):
+        self._disconnect_id = None
+        if not self.scheduler.idle:
+            self._touch()
+            return False
+        logger.info("Disconnecting from idle %s" % self.address)
+        self.idle_disconnected = True
+        self._sessions["idle_disconnects"] += 1
+        self.dev.disconnect_async(error_callback=lambda e: logger.warning(
+            "Disconnecting from %s failed with %s" % (self.address, e)))
+        return False
+
+    def session_stats(self):
+        """
+        Number of connections, the writes made per connection and the
+        fraction of the time spent connected
+        """
+        sessions = self._sessions["sessions"]
+        connected_time = self._sessions["connected_time"]
+        if self._connected_since is not None:
+            sessions += 1
+            connected_time += time.monotonic() - self._connected_since
+        return {
+            "sessions": sessions,
+            "idle_disconnects": self._sessions["idle_disconnects"],
+            "writes": self._sessions["writes"],
+            "writes_per_session": (self._sessions["writes"] / sessions
+                                   if sessions else 0.0),
+            "duty_cycle": connected_time / (time.monotonic() - self._created),
+        }
 
     def connect(self):
-        # We also want to wait until services are resolved
-        while not self.dev.connected or not self.dev.services_resolved:
-            if not self.dev.connected:
+        if self.dev.connected and self.dev.services_resolved:
+            return
+        # We also want to wait until services are resolved. The properties
+        # have to be read from the remote object, as the object mirror is only
+        # updated once we get back to the event loop.
+        start = time.monotonic()
+        while not self.dev.get_remote("Connected") or \
+                not self.dev.get_remote("ServicesResolved"):
+            if not self.dev.get_remote("Connected"):
+                metrics.connect_attempts.inc(address=self.address)
                 try:
-                    # Problematically, dbus calls block the entire event loop
-                    # TODO: Fix this
+                    # Problematically, dbus calls block the entire event loop,
+                    # use connect_async where possible
                     self.dev.connect()
                 except GLib.GError:
                     # Just ignore everything for now
-                    pass
+                    metrics.connect_errors.inc(address=self.address)
             else:
                 time.sleep(0.1)
+        # For the same reason, the mirror does not know about the GATT objects
+        # yet, but we are going to need them right away
+        self.dev.mirror.reload()
+        metrics.connect_seconds.observe(time.monotonic() - start,
+                                        address=self.address)
+
+    def forget_shadow(self):
+        """ Makes the next write to every characteristic go through """
+        self._shadow.clear()
+
+    def _unshadow(self, uuid, data):
+        if self._shadow.get(uuid) == data:
+            del self._shadow[uuid]
+
+    def _write(self, uuid, data, priority, key=None, force=False,
+               callback=None, error_callback=None):
+        data = bytes(data)
+        if self.journal is not None and not self.dev.connected:
+            self.journal.append(uuid, data, priority, key)
+            # Only wake the watch up if we hung up ourselves, otherwise
+            # reconnecting is up to the reconnect schedule
+            if self.idle_disconnected and not self._connecting and \
+                    self._wake_id is None:
+                self._wake()
+            if callback:
+                callback()
+            return
+        self._submit(uuid, data, priority, key, force, callback,
+                     error_callback)
+
+    def _submit(self, uuid, data, priority, key=None, force=False,
+                callback=None, error_callback=None):
+        if not force and self._shadow.get(uuid) == data:
+            if callback:
+                callback()
+            return
+        self._shadow[uuid] = data
+        def error_cb(e):
+            self._unshadow(uuid, data)
+            if self.journal is not None and not self.dev.connected:
+                logger.debug("Journaling write to %s: %s" % (uuid, e))
+                self.journal.append(uuid, data, priority, key)
+                if callback:
+                    callback()
+                return
+            if isinstance(e, QueueFull):
+                logger.debug("Write to %s dropped: %s" % (uuid, e))
+            else:
+                logger.warning("Write to %s failed with %s" % (uuid, e))
+            if error_callback:
+                error_callback(e)
+        try:
+            self.scheduler.submit(uuid, data, priority, key=key,
+                                  callback=callback, error_callback=error_cb)
+        except QueueFull:
+            self._unshadow(uuid, data)
+            raise
+
+    def replay_journal(self):
+        """ Submits everything from the journal in one go """
+        if self.journal is None or not len(self.journal):
+            return
+        entries = self.journal.drain()
+        logger.info("Replaying %d journaled writes to %s" %
+                    (len(entries), self.address))
+        for entry in entries:
+            data = entry.data
+            if entry.uuid == Asteroid.UUID_TIME:
+                # A stale time is worse than none
+                data = encode_time(datetime.datetime.now())
+            try:
+                self._submit(entry.uuid, data, entry.priority, entry.key,
+                             force=True)
+            except QueueFull:
+                self.journal.append(entry.uuid, entry.data, entry.priority,
+                                    entry.key)
+
+    def _write_raw(self, uuid, data, callback, error_callback):
+        if not self.dev.connected or not self.dev.services_resolved:
+            retry = lambda: self._write_raw(uuid, data, callback,
+                                            error_callback)
+            if self.idle_disconnected:
+                self._wake(retry, error_callback)
+            else:
+                # Connecting on every write would defeat the backoff of
+                # ReconnectModule, wait for the link to come back instead
+                self._link_waiters.append(retry)
+            return
+        def written():
+            self._sessions["writes"] += 1
+            self._touch()
+            callback()
+        self.dev.char_by_uuid(uuid).write_async(data, callback=written,
+                                                error_callback=error_callback)
+
+    def _watch_battery(self):
+        # Notifications have to be enabled again on every connection, the
+        # subscription stays valid as the object path does not change
+        try:
+            char = self.dev.char_by_uuid(Asteroid.UUID_BATTERY)
+        except IOError:
+            return
+        if self._battery_subscription is None:
+            self._battery_subscription = \
+                char.properties_changed.connect(self._battery_changed)
+        def failed(e):
+            logger.warning("Battery updates from %s unavailable: %s" %
+                           (self.address, e))
+        char.start_notify_async(error_callback=failed)
+        char.read_async(lambda value: self._record_battery(value[0]), failed)
+
+    def _battery_changed(self, name, changed, lst):
+        if changed.get("Value"):
+            self._record_battery(changed["Value"][0])
+
+    def _record_battery(self, level):
+        self._battery_level = level
+        self.battery_history.append(time.time(), level)
 
     @ensure_connected
+    def _read_battery(self):
+        self._record_battery(
+            self.dev.char_by_uuid(Asteroid.UUID_BATTERY).read()[0])
+
     def battery_level(self):
-        return self.dev.char_by_uuid(Asteroid.UUID_BATTERY).read()[0]
+        """
+        The last battery level the watch reported, only read (blocking) if
+        nothing is known yet
+        """
+        if self._battery_level is None:
+            self._read_battery()
+        return self._battery_level
 
-    @ensure_connected
-    def update_time(self, to=None):
+    def battery_level_async(self, callback, error_callback=None):
+        if self._battery_level is not None:
+            call_soon(callback, self._battery_level)
+            return
+        def read(value):
+            self._record_battery(value[0])
+            callback(value[0])
+        def connected():
+            self.dev.char_by_uuid(Asteroid.UUID_BATTERY).read_async(
+                read, error_callback)
+        self.connect_async(connected, error_callback)
+
+    def battery_drain_rate(self, window=6 * 60 * 60):
+        """
+        Percent per hour the battery lost over the last window seconds,
+        negative while charging. None without enough samples.
+        """
+        slope = self.battery_history.slope(time.time() - window)
+        return None if slope is None else -slope * 60 * 60
+
+    def update_time(self, to=None, force=False, callback=None,
+                    error_callback=None):
         if to is None:
             to = datetime.datetime.now()
-        data = [
-            to.year - 1900,
-            to.month - 1,
-            to.day,
-            to.hour,
-            to.minute,
-            to.second
-        ]
-        self.dev.char_by_uuid(Asteroid.UUID_TIME).write(data)
+        self._write(Asteroid.UUID_TIME, encode_time(to),
+                    WriteScheduler.PRIORITY_TIME,
+                    force=force, callback=callback,
+                    error_callback=error_callback)
 
-    @ensure_connected
-    def screenshot(self):
-        # TODO: This disconnects after a few callbacks, fix
-        crsp = self.dev.char_by_uuid(Asteroid.UUID_SCREENSHOT_RESP)
+    def screenshot_async(self, callback, error_callback=None, fileobj=None,
+                         timeout=10):
+        """
+        Takes a screenshot. callback gets the image bytes, or None if they
+        were streamed into fileobj instead, and the ScreenshotStats of the
+        transfer. error_callback gets an IOError or GLib.Error, timeout is the
+        number of seconds to wait for the next chunk.
+        """
+        transfer = ScreenshotTransfer(self, callback, error_callback,
+                                      fileobj, timeout)
+        self.connect_async(transfer.start, transfer.fail)
+
+    def screenshot(self, fileobj=None, timeout=10):
         loop = GLib.MainLoop()
-        data_rem = None
-        def cb(*args):
-            print(args)
-            #loop.quit()
-        crsp.start_notify()
-        crsp.properties_changed.connect(cb)
-        self.dev.char_by_uuid(Asteroid.UUID_SCREENSHOT_REQ).write(b"\x00")
+        result = []
+        def done(*args):
+            result.append(args)
+            loop.quit()
+        self.screenshot_async(lambda data, stats: done(data, None),
+                              lambda e: done(None, e),
+                              fileobj=fileobj, timeout=timeout)
         loop.run()
+        data, error = result[0]
+        if error is not None:
+            raise error
+        return data
+
+    def flush(self, timeout=10):
+        """
+        Runs the event loop until all queued writes went through, for callers
+        which do not run one themselves. Returns False if that takes longer
+        than timeout seconds.
+        """
+        loop = GLib.MainLoop()
+        deadline = time.monotonic() + timeout
+        def check():
+            if self.scheduler.idle or time.monotonic() > deadline:
+                loop.quit()
+                return False
+            return True
+        GLib.timeout_add(10, check)
+        loop.run()
+        return self.scheduler.idle
+
+    def notify_budget(self):
+        """ Maximum size of an encoded notification, in bytes """
+        if self.notify_max_bytes is not None:
+            return self.notify_max_bytes
+        mtu = None
+        if self.dev.services_resolved:
+            try:
+                mtu = self.dev.char_by_uuid(Asteroid.UUID_NOTIF_UPD).mtu
+            except IOError:
+                pass
+        if mtu is None:
+            # Older BlueZ versions do not tell us
+            return ATT_MAX_VALUE_LEN
+        return min((mtu - 3) * self.notify_max_packets, ATT_MAX_VALUE_LEN)
 
-    @ensure_connected
     def notify(self, summary, body=None, id_=None, package_name=None,
-               app_name=None, app_icon=None):
+               app_name=None, app_icon=None, force=False, max_bytes=None,
+               callback=None, error_callback=None):
         if id_ is None:
             id_ = random.randint(0, 2 ** 31)
         id_ = str(id_)
-        xinsert = xml.etree.ElementTree.Element("insert")
-        for vl, xn in ((summary, "su"),
-                       (body, "bo"),
-                       (id_, "id"),
-                       (package_name, "pn"),
-                       (app_name, "an"),
-                       (app_icon, "ai")):
-            if vl is not None:
-                xel = xml.etree.ElementTree.SubElement(xinsert, xn)
-                xel.text = vl
-        data = xml.etree.ElementTree.tostring(xinsert)
-        self.dev.char_by_uuid(Asteroid.UUID_NOTIF_UPD).write(data)
+        data = encode_notification(
+                    summary, body, id_, package_name, app_name, app_icon,
+                    self.notify_budget() if max_bytes is None else max_bytes)
+        self._write(Asteroid.UUID_NOTIF_UPD, data,
+                    WriteScheduler.PRIORITY_NOTIFICATION,
+                    key=(Asteroid.UUID_NOTIF_UPD, id_), force=force,
+                    callback=callback, error_callback=error_callback)
         return id_
 
-    @ensure_connected
-    def update_weather(self, predictions):
+    def update_weather(self, predictions, force=False, callback=None,
+                       error_callback=None):
+        prio = WriteScheduler.PRIORITY_WEATHER
+        group = _WriteGroup(callback, error_callback)
         # Set city name
-        self.dev.char_by_uuid(Asteroid.UUID_WEATHER_CITY).write(
-            predictions.city_name.encode())
-        self.dev.char_by_uuid(Asteroid.UUID_WEATHER_IDS).write(
-            struct.pack(">5H", *[round(p.id_) for p in predictions.values]))
-        self.dev.char_by_uuid(Asteroid.UUID_WEATHER_MINT).write(
-            struct.pack(">5H", *[round(p.min_) for p in predictions.values]))
-        self.dev.char_by_uuid(Asteroid.UUID_WEATHER_MAXT).write(
-            struct.pack(">5H", *[round(p.max_) for p in predictions.values]))
-
-    def update_media(self, title, album, artist, playing):
-        self.dev.char_by_uuid(Asteroid.UUID_MEDIA_TITLE).write(title.encode())
-        self.dev.char_by_uuid(Asteroid.UUID_MEDIA_ALBUM).write(album.encode())
-        self.dev.char_by_uuid(Asteroid.UUID_MEDIA_ARTIST).write(artist.encode())
-        self.dev.char_by_uuid(Asteroid.UUID_MEDIA_PLAY).write(
-            b"\x01" if playing else b"\x00")
+        self._write(Asteroid.UUID_WEATHER_CITY,
+            predictions.city_name.encode(), prio, force=force, **group.add())
+        self._write(Asteroid.UUID_WEATHER_IDS,
+            struct.pack(">5H", *[round(p.id_) for p in predictions.values]),
+            prio, force=force, **group.add())
+        self._write(Asteroid.UUID_WEATHER_MINT,
+            struct.pack(">5H", *[round(p.min_) for p in predictions.values]),
+            prio, force=force, **group.add())
+        self._write(Asteroid.UUID_WEATHER_MAXT,
+            struct.pack(">5H", *[round(p.max_) for p in predictions.values]),
+            prio, force=force, **group.add())
+        group.close()
+
+    def update_media(self, title=None, album=None, artist=None, playing=None,
+                     force=False, callback=None, error_callback=None):
+        # Fields which are None are left as they are
+        prio = WriteScheduler.PRIORITY_MEDIA
+        group = _WriteGroup(callback, error_callback)
+        for uuid, value in ((Asteroid.UUID_MEDIA_TITLE, title),
+                            (Asteroid.UUID_MEDIA_ALBUM, album),
+                            (Asteroid.UUID_MEDIA_ARTIST, artist)):
+            if value is not None:
+                self._write(uuid, value.encode(), prio, force=force,
+                            **group.add())
+        if playing is not None:
+            self._write(Asteroid.UUID_MEDIA_PLAY,
+                        b"\x01" if playing else b"\x00", prio, force=force,
+                        **group.add())
+        group.close()
 
     def register_media_listener(self, fn):
-        # TODO: A way to unregister
+        """
+        Calls fn with every media command the watch sends, returns the
+        subscription, whose disconnect() unregisters fn again
+        """
         ccomm = self.dev.char_by_uuid(Asteroid.UUID_MEDIA_COMM)
         def cb(name, vals, lst):
             if not "Value" in vals:
                 return
             fn(vals["Value"][0])
-        ccomm.properties_changed.connect(cb)
+        subscription = ccomm.properties_changed.connect(cb)
         ccomm.start_notify()
+        return subscription
+
+
+battery_gauge = metrics.REGISTRY.gauge(
+    "asteroid_battery_level_percent",
+    "Last battery level reported by the watch",
+    lambda address: Asteroid._instances[address]._battery_level
+                    if address in Asteroid._instances and
+                       Asteroid._instances[address]._battery_level is not None
+                    else float("nan"))
+
+uptime_gauge = metrics.REGISTRY.gauge(
+    "asteroid_connection_uptime_seconds",
+    "Time since the watch connected, 0 when disconnected",
+    lambda address: Asteroid._instances[address].uptime
+                    if address in Asteroid._instances else 0.0)
+
+
+duty_cycle_gauge = metrics.REGISTRY.gauge(
+    "asteroid_connected_duty_cycle",
+    "Fraction of the time the watch has been connected",
+    lambda address: Asteroid._instances[address].session_stats()["duty_cycle"]
+                    if address in Asteroid._instances else 0.0)
+
+
+class ScreenshotTransfer:
+    """
+    Receives one screenshot. The watch first notifies the total size as a
+    little endian 32-bit integer, followed by the image data in chunks, which
+    are copied straight into a preallocated buffer (or the file object).
+    """
+
+    Stats = collections.namedtuple(
+                "ScreenshotStats", ["size", "chunks", "elapsed", "throughput"])
+
+    def __init__(self, asteroid, callback, error_callback, fileobj, timeout):
+        self.asteroid = asteroid
+        self.callback = callback
+        self.error_callback = error_callback
+        self.fileobj = fileobj
+        self.timeout = timeout
+        self.size = None
+        self.received = 0
+        self.chunks = 0
+        self._buffer = None
+        self._view = None
+        self._char = None
+        self._subscription = None
+        self._timeout_id = None
+        self._started = None
+        self._done = False
+
+    def start(self):
+        try:
+            self._char = self.asteroid.dev.char_by_uuid(
+                                            Asteroid.UUID_SCREENSHOT_RESP)
+        except IOError as e:
+            self.fail(e)
+            return
+        self._started = time.monotonic()
+        self._rearm()
+        self._subscription = \
+            self._char.properties_changed.connect(self._properties_changed)
+        self._char.start_notify_async(self._request, self.fail)
+
+    def _request(self):
+        self.asteroid._write(Asteroid.UUID_SCREENSHOT_REQ, b"\x00",
+                             WriteScheduler.PRIORITY_NOTIFICATION, force=True)
+
+    def _rearm(self):
+        # Keep the connection up for as long as the transfer goes on
+        self.asteroid._touch()
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+        self._timeout_id = GLib.timeout_add_seconds(self.timeout,
+                                                    self._timed_out)
+
+    def _timed_out(self):
+        self._timeout_id = None
+        self.fail(IOError("Screenshot transfer timed out after %d of %s bytes"
+                          % (self.received, self.size)))
+        return False
+
+    def _properties_changed(self, name, changed, lst):
+        if self._done or "Value" not in changed:
+            return
+        chunk = memoryview(bytes(changed["Value"]))
+        self._rearm()
+        if self.size is None:
+            if len(chunk) < 4:
+                self.fail(IOError("Invalid screenshot header"))
+                return
+            self.size, = struct.unpack_from("<I", chunk)
+            if self.fileobj is None:
+                self._buffer = bytearray(self.size)
+                self._view = memoryview(self._buffer)
+            chunk = chunk[4:]
+            if not chunk and self.size:
+                return
+        chunk = chunk[:self.size - self.received]
+        if self._view is not None:
+            self._view[self.received:self.received + len(chunk)] = chunk
+        else:
+            self.fileobj.write(chunk)
+        self.received += len(chunk)
+        self.chunks += 1
+        if self.received >= self.size:
+            self._finish()
+
+    def _cleanup(self):
+        self._done = True
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+        if self._subscription is not None:
+            self._subscription.disconnect()
+            self._subscription = None
+        if self._char is not None and self._started is not None:
+            self._char.stop_notify_async()
+
+    def _finish(self):
+        self._cleanup()
+        elapsed = time.monotonic() - self._started
+        stats = ScreenshotTransfer.Stats(
+                    size=self.size, chunks=self.chunks, elapsed=elapsed,
+                    throughput=self.size / elapsed if elapsed else 0.0)
+        self.asteroid.screenshot_stats = stats
+        logger.debug("Screenshot of %d bytes in %d chunks, %.1f B/s" %
+                     (stats.size, stats.chunks, stats.throughput))
+        if self._view is not None:
+            self._view.release()
+        self.callback(self._buffer, stats)
+
+    def fail(self, error):
+        if self._done:
+            return
+        self._cleanup()
+        if self.error_callback:
+            self.error_callback(error)
+
+
+def _match_rule(**kwargs):
+    """ Builds a D-Bus match rule, quoting the values """
+    return ",".join("%s='%s'" % (k, str(v).replace("'", "'\\''"))
+                    for k, v in kwargs.items())
 
 
 class DBusEavesdropper:
+    """
+    Captures method calls made by other clients on the bus. It prefers
+    becoming a monitor (org.freedesktop.DBus.Monitoring.BecomeMonitor) on a
+    dedicated connection, which only gets the matching messages delivered.
+    When the bus does not allow that, it falls back to an eavesdropping match
+    and a filter on the given bus connection.
+    """
+
+    # Set while an asteroid.recorder.Recorder is running
+    recorder = None
 
-    def __init__(self, bus, interface, member, callback):
+    def __init__(self, bus, interface, member, callback, monitor=True):
         self.bus = bus
         self.interface = interface
         self.member = member
         self.callback = callback
+        self._monitor_con = None
+        self._filter_con = None
+        self._filter_id = None
+        self._match = None
         self._dbus_ctl = self.bus.get("org.freedesktop.DBus")
-        # TODO: Escaping
-        # TODO: We probably want to unregister when destroyed?
-        self._match_id = self._dbus_ctl.AddMatch(
-                            "interface=%s,member=%s,eavesdrop=true" %
-                            (interface, member))
-        self.bus.con.add_filter(self._filter_func)
-
-    def _filter_func(self, con, msg, bl):
-        if msg.get_interface() == self.interface and \
+        if monitor:
+            try:
+                self._start_monitor()
+            except GLib.Error as e:
+                logger.info("Can not become a monitor (%s), falling back to "
+                            "eavesdropping" % e.message)
+                self._close_monitor()
+        if self._monitor_con is None:
+            self._start_eavesdrop()
+
+    @property
+    def monitoring(self):
+        return self._monitor_con is not None
+
+    def _start_monitor(self):
+        # The monitor needs a connection of its own, as it can not be used
+        # for anything else afterwards
+        session = Gio.bus_get_sync(Gio.BusType.SESSION, None)
+        bus_type = Gio.BusType.SESSION if self.bus.con == session \
+            else Gio.BusType.SYSTEM
+        address = Gio.dbus_address_get_for_bus_sync(bus_type, None)
+        self._monitor_con = Gio.DBusConnection.new_for_address_sync(
+            address,
+            Gio.DBusConnectionFlags.AUTHENTICATION_CLIENT |
+            Gio.DBusConnectionFlags.MESSAGE_BUS_CONNECTION,
+            None, None)
+        rule = _match_rule(type="method_call", interface=self.interface,
+                           member=self.member)
+        self._filter_con = self._monitor_con
+        self._filter_id = self._monitor_con.add_filter(self._filter_func)
+        self._monitor_con.call_sync(
+            "org.freedesktop.DBus", "/org/freedesktop/DBus",
+            "org.freedesktop.DBus.Monitoring", "BecomeMonitor",
+            GLib.Variant("(asu)", ([rule], 0)), None,
+            Gio.DBusCallFlags.NONE, -1, None)
+
+    def _close_monitor(self):
+        if self._monitor_con is None:
+            return
+        if self._filter_con is self._monitor_con:
+            self._monitor_con.remove_filter(self._filter_id)
+            self._filter_con = self._filter_id = None
+        try:
+            self._monitor_con.close_sync(None)
+        except GLib.Error:
+            # Closed already
+            pass
+        self._monitor_con = None
+
+    def _start_eavesdrop(self):
+        self._match = _match_rule(type="method_call",
+                                  interface=self.interface,
+                                  member=self.member, eavesdrop="true")
+        self._dbus_ctl.AddMatch(self._match)
+        self._filter_con = self.bus.con
+        self._filter_id = self.bus.con.add_filter(self._filter_func)
+
+    def unregister(self):
+        if self._filter_id is not None:
+            self._filter_con.remove_filter(self._filter_id)
+            self._filter_id = None
+        if self._match is not None:
+            self._dbus_ctl.RemoveMatch(self._match)
+            self._match = None
+        self._close_monitor()
+
+    def _filter_func(self, con, msg, incoming):
+        if incoming and \
+                msg.get_message_type() == Gio.DBusMessageType.METHOD_CALL and \
+                msg.get_interface() == self.interface and \
                 msg.get_member() == self.member:
+            if DBusEavesdropper.recorder is not None:
+                DBusEavesdropper.recorder.record_eavesdropped(msg)
             self.callback(msg)
+            # The call was not meant for us, make sure that GDBus does not
+            # try to handle it (monitors must never reply to anything)
+            return None
+        return msg
@@ -0,0 +1,163 @@
+"""
+asyncio interface. pydbus, and therefore everything else, is driven by the
+GLib main loop, which runs in a single background thread here. Coroutines
+hand their calls over to that thread and are woken up once the callbacks
+fire, so any number of operations on any number of watches can be awaited
+concurrently without blocking the asyncio loop.
+"""
+
+import asyncio
+import random
+import threading
+from asteroid import Asteroid
+from gi.repository import GLib
+
+
+def _set_result(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def _set_exception(future, error):
+    if not future.done():
+        future.set_exception(error)
+
+
+class GLibThread:
+    """ Runs the default GLib main context in a daemon thread """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(class_):
+        with class_._lock:
+            if class_._instance is None:
+                class_._instance = class_()
+            return class_._instance
+
+    def __init__(self):
+        self.loop = GLib.MainLoop()
+        self.thread = threading.Thread(target=self.loop.run, name="glib",
+                                       daemon=True)
+        self.thread.start()
+
+    def call(self, fn, *args):
+        """
+        Runs fn(*args, callback, error_callback) in the GLib thread and
+        returns an asyncio future for the value passed to callback. Anything
+        fn raises ends up in the future as well.
+        """
+        aloop = asyncio.get_running_loop()
+        future = aloop.create_future()
+        def resolve(value=None):
+            aloop.call_soon_threadsafe(_set_result, future, value)
+        def reject(error):
+            aloop.call_soon_threadsafe(_set_exception, future, error)
+        def run():
+            try:
+                fn(*args, resolve, reject)
+            except Exception as e:
+                reject(e)
+            return False
+        GLib.idle_add(run)
+        return future
+
+    def call_soon(self, fn, *args):
+        """ Runs fn(*args) in the GLib thread, without waiting for it """
+        def run():
+            fn(*args)
+            return False
+        GLib.idle_add(run)
+
+
+class AsyncAsteroid:
+    """
+    asyncio counterpart of Asteroid, get one with
+
+        watch = await AsyncAsteroid.create(address)
+
+    The update coroutines return once the data has been written to the watch
+    (or to the journal, while it is away) and raise QueueFull, IOError or
+    GLib.Error otherwise.
+    """
+
+    def __init__(self, asteroid, glib=None):
+        self.asteroid = asteroid
+        self._glib = glib if glib is not None else GLibThread.get()
+
+    @classmethod
+    async def create(class_, address, ble=None):
+        glib = GLibThread.get()
+        asteroid = await glib.call(
+                        lambda callback, error_callback:
+                            callback(Asteroid(address, ble)))
+        return class_(asteroid, glib)
+
+    @property
+    def address(self):
+        return self.asteroid.address
+
+    def _update(self, method, *args, **kwargs):
+        def start(callback, error_callback):
+            method(*args, callback=callback, error_callback=error_callback,
+                   **kwargs)
+        return self._glib.call(start)
+
+    async def connect(self):
+        await self._glib.call(self.asteroid.connect_async)
+
+    async def notify(self, summary, body=None, id_=None, package_name=None,
+                     app_name=None, app_icon=None, force=False,
+                     max_bytes=None):
+        if id_ is None:
+            id_ = random.randint(0, 2 ** 31)
+        id_ = str(id_)
+        await self._update(self.asteroid.notify, summary, body, id_,
+                           package_name, app_name, app_icon, force=force,
+                           max_bytes=max_bytes)
+        return id_
+
+    async def update_media(self, title=None, album=None, artist=None,
+                           playing=None, force=False):
+        await self._update(self.asteroid.update_media, title, album, artist,
+                           playing, force=force)
+
+    async def update_weather(self, predictions, force=False):
+        await self._update(self.asteroid.update_weather, predictions,
+                           force=force)
+
+    async def update_time(self, to=None, force=False):
+        await self._update(self.asteroid.update_time, to, force=force)
+
+    async def battery_level(self):
+        return await self._glib.call(self.asteroid.battery_level_async)
+
+    async def screenshot(self, fileobj=None, timeout=10):
+        """
+        Returns the image bytes, or None if they were written to fileobj,
+        which happens from the GLib thread
+        """
+        def start(callback, error_callback):
+            self.asteroid.screenshot_async(
+                lambda data, stats: callback(data), error_callback,
+                fileobj=fileobj, timeout=timeout)
+        return await self._glib.call(start)
+
+    async def media_commands(self):
+        """
+        Yields the media commands (Asteroid.MEDIA_COMMAND_*) sent by the
+        watch, for as long as the generator is kept running
+        """
+        aloop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        def command(value):
+            aloop.call_soon_threadsafe(queue.put_nowait, value)
+        subscription = await self._glib.call(
+                        lambda callback, error_callback: callback(
+                            self.asteroid.register_media_listener(command)))
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._glib.call_soon(subscription.disconnect)
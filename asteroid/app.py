@@ -1,33 +1,41 @@
 
 import cmd
-import colorama
 import functools
 import logging
 import queue
 import sys
 import threading
+import time
 from gi.repository import GLib
 
 import asteroid
+from asteroid import LazyModule, bleee, metrics
+from asteroid.dispatch import PropertyDispatcher
+from asteroid.journal import Journal
+from asteroid.watchdog import LoopMonitor
+
+colorama = LazyModule("colorama")
 
 
 class LogFormatter(logging.Formatter):
 
+    _namecolors = {
+        "DEBUG": ("DBG", "LIGHTWHITE_EX"),
+        "INFO": ("INF", "LIGHTBLUE_EX"),
+        "WARNING": ("WRN", "LIGHTYELLOW_EX"),
+        "ERROR": ("ERR", "LIGHTRED_EX"),
+        "CRITICAL": ("CRT", "LIGHTRED_EX"),
+        "UNKNOWN": ("???", "LIGHTWHITE_EX")
+    }
+
     @staticmethod
     @functools.lru_cache(10)
     def _prefix(prefix, color):
+        # colorama only gets imported with the first log message
+        color = getattr(colorama.Fore, color)
         return colorama.Style.RESET_ALL + "[" + color + prefix + \
             colorama.Style.RESET_ALL + "]"
 
-    _namecolors = {
-        "DEBUG": ("DBG", colorama.Fore.LIGHTWHITE_EX),
-        "INFO": ("INF", colorama.Fore.LIGHTBLUE_EX),
-        "WARNING": ("WRN", colorama.Fore.LIGHTYELLOW_EX),
-        "ERROR": ("ERR", colorama.Fore.LIGHTRED_EX),
-        "CRITICAL": ("CRT", colorama.Fore.LIGHTRED_EX),
-        "UNKNOWN": ("???", colorama.Fore.LIGHTWHITE_EX)
-    }
-
     def format(self, record):
         prefix = LogFormatter._prefix(
                     *LogFormatter._namecolors.get(
@@ -38,11 +46,56 @@ class LogFormatter(logging.Formatter):
 
 class App:
 
-    def __init__(self, address, cmd=True, verbose=False):
+    def __init__(self, address, cmd=True, verbose=False, metrics_path=None,
+                 metrics_interval=15, journal=True, record_path=None,
+                 stall_threshold=0.25):
         self._setup_logging(verbose)
-        self.asteroid = asteroid.Asteroid(address)
+        # Seconds spent in each startup phase
+        self.startup_times = {"import": asteroid.import_seconds}
+        addresses = [address] if isinstance(address, str) else list(address)
+        # All the watches share one adapter object and bus connection
+        start = time.perf_counter()
+        self.ble = bleee.BLE()
+        self.startup_times["dbus"] = time.perf_counter() - start
+        start = time.perf_counter()
+        self.asteroids = []
+        for addr in addresses:
+            ast = asteroid.Asteroid(addr, ble=self.ble,
+                                    journal=Journal(Journal.default_path(addr))
+                                            if journal else None)
+            try:
+                # Resolved from the object mirror, so this is cheap
+                ast.dev
+            except IOError as e:
+                self.logger.error("Skipping watch %s: %s" % (addr, e))
+                continue
+            self.asteroids.append(ast)
+        self.startup_times["devices"] = time.perf_counter() - start
+        if not self.asteroids:
+            raise IOError("None of the watches %s is known" %
+                          ", ".join(addresses))
+        # Modules get the device property changes through this
+        self.dispatcher = PropertyDispatcher()
+        for ast in self.asteroids:
+            self.dispatcher.watch(ast)
+        self.asteroid = self.asteroids[0]
         self.loop = GLib.MainLoop()
         self.modules = []
+        self.metrics_exporter = None
+        if metrics_path is not None:
+            self.metrics_exporter = metrics.TextfileExporter(
+                                        metrics_path, metrics_interval)
+            self.metrics_exporter.start()
+        # Reports callbacks which block the loop for longer than this
+        self.loop_monitor = None
+        if stall_threshold is not None:
+            self.loop_monitor = LoopMonitor(stall_threshold)
+        self.recorder = None
+        if record_path is not None:
+            # Imported here, the recorder is rarely needed
+            from asteroid.recorder import Recorder
+            self.recorder = Recorder(record_path, self.ble.bus.con)
+            self.recorder.start()
 
     def _setup_logging(self, verbose):
         syslog = logging.StreamHandler(sys.stderr)
@@ -52,11 +105,45 @@ class App:
         self.logger.setLevel(logging.DEBUG if verbose else logging.INFO)
         self.logger.addHandler(syslog)
 
+    def startup_report(self):
+        return "Started in %.3f s (import %.3f s, D-Bus setup %.3f s, " \
+               "devices %.3f s, modules %.3f s)" % (
+                    sum(self.startup_times.values()),
+                    self.startup_times.get("import", 0.0),
+                    self.startup_times.get("dbus", 0.0),
+                    self.startup_times.get("devices", 0.0),
+                    self.startup_times.get("modules", 0.0))
+
     def run(self):
+        self.logger.info(self.startup_report())
         self.logger.info("Entering GLib event loop")
+        if self.loop_monitor is not None:
+            self.loop_monitor.start()
         self.loop.run()
 
-    def register_module(self, module):
-        module.register(self)
+    def flush(self, timeout=10):
+        """ Asteroid.flush for all the watches """
+        return all([ast.flush(timeout) for ast in self.asteroids])
+
+    def asteroid_by_address(self, address):
+        for ast in self.asteroids:
+            if ast.address == address:
+                return ast
+        raise KeyError(address)
+
+    def register_module(self, module, isolate=False):
+        """
+        With isolate, the module runs in a worker process of its own, see
+        asteroid.isolation for what such modules can do
+        """
+        start = time.perf_counter()
+        if isolate:
+            from asteroid.isolation import ModuleProcess
+            module = ModuleProcess(self, module)
+        else:
+            module.register(self)
+        self.startup_times["modules"] = \
+            self.startup_times.get("modules", 0.0) + \
+            time.perf_counter() - start
         # We don't really do anything with these yet, but just in case
         self.modules.append(module)
@@ -1,13 +1,172 @@
-
+import functools
+import time
 import xml
 import pydbus as dbus
+from asteroid import metrics
+from gi.repository import Gio, GLib
 
 # Hacky Bluez dbus interface wrapper: TODO: Improve
 
 BLUEZ_BUS = "org.bluez"
+DEVICE_IFACE = "org.bluez.Device1"
+GATT_CHARACTERISTIC_IFACE = "org.bluez.GattCharacteristic1"
+OBJECT_MANAGER_IFACE = "org.freedesktop.DBus.ObjectManager"
+PROPERTIES_IFACE = "org.freedesktop.DBus.Properties"
+
+_MISSING = object()
+
+
+def _parent_path(path):
+    return path.rsplit("/", 1)[0] or "/"
+
+
+class ObjectManagerMirror:
+    """
+    In-process copy of the objects managed by a D-Bus service. It is filled
+    once from GetManagedObjects and then kept current from the ObjectManager
+    and Properties signals. Each path is indexed under its parent, so subtree
+    queries do not have to scan every known object.
+    """
+
+    _instances = {}
+
+    @classmethod
+    def get(class_, bus, bus_name):
+        # Every pydbus.SystemBus() is a new object, but the connection is shared
+        key = (bus.con, bus_name)
+        if key not in class_._instances:
+            class_._instances[key] = class_(bus, bus_name)
+        return class_._instances[key]
+
+    def __init__(self, bus, bus_name):
+        self.bus = bus
+        self.bus_name = bus_name
+        self.objects = {}
+        self.children = {}
+        # Subscribe before loading, so that nothing gets lost in between
+        self._subscriptions = [
+            bus.subscribe(sender=bus_name, iface=OBJECT_MANAGER_IFACE,
+                          signal="InterfacesAdded",
+                          signal_fired=self._interfaces_added),
+            bus.subscribe(sender=bus_name, iface=OBJECT_MANAGER_IFACE,
+                          signal="InterfacesRemoved",
+                          signal_fired=self._interfaces_removed),
+            bus.subscribe(sender=bus_name, iface=PROPERTIES_IFACE,
+                          signal="PropertiesChanged",
+                          signal_fired=self._properties_changed),
+        ]
+        self.reload()
+
+    def reload(self):
+        objman = self.bus.get(self.bus_name, "/")
+        self.objects = {}
+        self.children = {}
+        for path, ifaces in objman.GetManagedObjects().items():
+            self.add_interfaces(path, ifaces)
+
+    def add_interfaces(self, path, ifaces):
+        if path in self.objects:
+            # The introspected proxy would be missing the new interfaces
+            _forget(self.bus, self.bus_name, path)
+        else:
+            self.objects[path] = {}
+            # Intermediate nodes do not have to be objects themselves, so
+            # link the whole chain up to the first already known ancestor
+            node = path
+            while node != "/":
+                parent = _parent_path(node)
+                known = parent in self.children
+                self.children.setdefault(parent, set()).add(node)
+                if known:
+                    break
+                node = parent
+        for iface, props in ifaces.items():
+            self.objects[path][iface] = dict(props)
+
+    def remove_interfaces(self, path, ifaces):
+        obj = self.objects.get(path)
+        if obj is None:
+            return
+        for iface in ifaces:
+            obj.pop(iface, None)
+        if obj:
+            _forget(self.bus, self.bus_name, path)
+            return
+        _forget(self.bus, self.bus_name, path, wrappers=True)
+        del self.objects[path]
+        # Prune the nodes which are neither objects nor have any children
+        node = path
+        while node != "/" and node not in self.objects and \
+                not self.children.get(node):
+            self.children.pop(node, None)
+            parent = _parent_path(node)
+            self.children.get(parent, set()).discard(node)
+            node = parent
+
+    def _interfaces_added(self, sender, path, iface, signal, params):
+        self.add_interfaces(*params)
+
+    def _interfaces_removed(self, sender, path, iface, signal, params):
+        self.remove_interfaces(*params)
+
+    def _properties_changed(self, sender, path, iface, signal, params):
+        iface_name, changed, invalidated = params
+        props = self.objects.get(path, {}).get(iface_name)
+        if props is None:
+            return
+        props.update(changed)
+        for name in invalidated:
+            props.pop(name, None)
+
+    def descendants(self, path, depth=1):
+        """ Yields (path, interfaces) of the objects up to depth levels below """
+        level = [path]
+        while level and (depth is None or depth > 0):
+            level = [c for p in level for c in self.children.get(p, ())]
+            for child in level:
+                if child in self.objects:
+                    yield child, self.objects[child]
+            if depth is not None:
+                depth -= 1
+
+    def children_info(self, path, depth=1):
+        """ Same as descendants, but only the objects exactly depth levels below """
+        if depth is None:
+            return self.descendants(path, depth=None)
+        level = [path]
+        for _ in range(depth):
+            level = [c for p in level for c in self.children.get(p, ())]
+        return ((c, self.objects[c]) for c in level if c in self.objects)
+
+    def get_property(self, path, name, default=_MISSING):
+        for props in self.objects.get(path, {}).values():
+            if name in props:
+                return props[name]
+        return default
+
+
+# (connection, bus name, path) -> proxy, introspecting is expensive
+_proxies = {}
+# (connection, bus name, path) -> {wrapper class: wrapper}
+_wrappers = {}
+
+
+def _forget(bus, bus_name, path, wrappers=False):
+    key = (bus.con, bus_name, path)
+    _proxies.pop(key, None)
+    if wrappers:
+        _wrappers.pop(key, None)
+
+
+@functools.lru_cache(maxsize=None)
+def _dbus_name(name):
+    return "".join(map(lambda s: s.capitalize(), name.split("_")))
+
 
 class DbusWrapper:
 
+    __slots__ = ("bus", "bus_name", "object_path", "mirror", "_key")
+
     _dbus_extra_names = {}
 
     def __init__(self, bus_name, object_path=None, bus=None):
@@ -18,13 +177,39 @@ class DbusWrapper:
         self.bus = bus
         self.bus_name = bus_name
         self.object_path = object_path
-        self.dbus_obj = bus.get(bus_name, object_path)
+        self.mirror = ObjectManagerMirror.get(bus, bus_name)
+        self._key = (bus.con, bus_name, object_path)
+
+    @classmethod
+    def for_path(class_, bus_name, object_path, bus):
+        """ Returns a shared wrapper for the object, creating it if needed """
+        pool = _wrappers.setdefault((bus.con, bus_name, object_path), {})
+        wrapper = pool.get(class_)
+        if wrapper is None:
+            wrapper = pool[class_] = class_(bus_name, object_path, bus=bus)
+        return wrapper
+
+    @property
+    def dbus_obj(self):
+        # Not kept on the wrapper, so that it is refreshed once the object's
+        # interfaces change
+        proxy = _proxies.get(self._key)
+        if proxy is None:
+            proxy = _proxies[self._key] = \
+                self.bus.get(self.bus_name, self.object_path)
+        return proxy
 
     def __getattr__(self, name):
-        if name in self._dbus_extra_names:
-            name = self._dbus_extra_names[name]
-        else:
-            name = "".join(map(lambda s: s.capitalize(), name.split("_")))
+        name = self._dbus_extra_names.get(name) or _dbus_name(name)
+        # Properties are served from the mirror, everything else goes to
+        # the remote object
+        value = self.mirror.get_property(self.object_path, name)
+        if value is not _MISSING:
+            return value
+        return getattr(self.dbus_obj, name)
+
+    def get_remote(self, name):
+        """ Reads a property from the remote object, bypassing the mirror """
         return getattr(self.dbus_obj, name)
 
     def introspect(self):
@@ -35,37 +220,176 @@ class DbusWrapper:
         return DbusWrapper(self.bus_name, self.object_path + "/" + postfix, bus=self.bus)
 
     def list_children_info(self, depth=1):
-        prefix = self.object_path
-        objman = DbusWrapper(self.bus_name, "/", bus=self.bus)
-        for k, v in objman.get_managed_objects().items():
-            if k.startswith(prefix) and (depth is None or len(k[len(prefix):].split("/")) == (depth + 1)):
-                yield k, v
+        return self.mirror.children_info(self.object_path, depth=depth)
+
+    def call_async(self, iface, method, args=None, signature=None,
+                   callback=None, error_callback=None, timeout=-1):
+        """
+        Calls a method without waiting for the reply. callback gets the
+        unpacked return values, error_callback the GLib.Error.
+        """
+        params = GLib.Variant(signature, args) if signature else None
+        self.bus.con.call(self.bus_name, self.object_path, iface, method,
+                          params, None, Gio.DBusCallFlags.NONE, timeout, None,
+                          self._call_async_done, (callback, error_callback))
+
+    @staticmethod
+    def _call_async_done(con, result, user_data):
+        callback, error_callback = user_data
+        try:
+            ret = con.call_finish(result).unpack()
+        except GLib.Error as e:
+            if error_callback:
+                error_callback(e)
+            return
+        if callback:
+            callback(*ret)
 
 
 class BLECharacteristic(DbusWrapper):
 
-    _dbus_extra_names = {"uuid": "UUID"}
+    __slots__ = ("_uuid",)
+
+    def __init__(self, *args, **kwargs):
+        super(BLECharacteristic, self).__init__(*args, **kwargs)
+        # Resolved once, the metrics and error paths must keep working after
+        # the object is gone from BlueZ
+        self._uuid = self.mirror.get_property(self.object_path, "UUID", None)
+
+    @property
+    def uuid(self):
+        if self._uuid is None:
+            self._uuid = self.mirror.get_property(self.object_path, "UUID",
+                                                  None)
+        return self._uuid or "unknown"
+
+    @property
+    def mtu(self):
+        """ The negotiated ATT MTU, None if BlueZ does not expose it """
+        return self.mirror.get_property(self.object_path, "MTU", None)
+
+    def _observe(self, op, start, error=None):
+        labels = {"op": op, "uuid": self.uuid}
+        metrics.gatt_seconds.observe(time.monotonic() - start, **labels)
+        if error is not None:
+            metrics.gatt_errors.inc(**labels)
+
+    def _instrument(self, op, callback, error_callback):
+        start = time.monotonic()
+        def done(*args):
+            try:
+                self._observe(op, start)
+            finally:
+                if callback:
+                    callback(*args)
+        def failed(e):
+            try:
+                self._observe(op, start, e)
+            finally:
+                if error_callback:
+                    error_callback(e)
+        return done, failed
 
     def write(self, data):
-        self.write_value(bytes(data), {})
+        data = bytes(data)
+        start = time.monotonic()
+        try:
+            self.write_value(data, {})
+        except GLib.Error as e:
+            self._observe("write", start, e)
+            raise
+        self._observe("write", start)
+        metrics.gatt_bytes_written.inc(len(data), uuid=self.uuid)
 
     def read(self):
-        return bytes(self.read_value({}))
+        start = time.monotonic()
+        try:
+            ret = bytes(self.read_value({}))
+        except GLib.Error as e:
+            self._observe("read", start, e)
+            raise
+        self._observe("read", start)
+        return ret
+
+    def write_async(self, data, callback=None, error_callback=None):
+        data = bytes(data)
+        def written():
+            try:
+                metrics.gatt_bytes_written.inc(len(data), uuid=self.uuid)
+            finally:
+                if callback:
+                    callback()
+        done, failed = self._instrument("write", written, error_callback)
+        self.call_async(GATT_CHARACTERISTIC_IFACE, "WriteValue",
+                        (data, {}), "(aya{sv})",
+                        callback=done, error_callback=failed)
+
+    def read_async(self, callback, error_callback=None):
+        done, failed = self._instrument(
+                            "read", lambda value: callback(bytes(value)),
+                            error_callback)
+        self.call_async(GATT_CHARACTERISTIC_IFACE, "ReadValue",
+                        ({},), "(a{sv})",
+                        callback=done, error_callback=failed)
+
+    def start_notify_async(self, callback=None, error_callback=None):
+        self.call_async(GATT_CHARACTERISTIC_IFACE, "StartNotify",
+                        callback=callback, error_callback=error_callback)
+
+    def stop_notify_async(self, callback=None, error_callback=None):
+        self.call_async(GATT_CHARACTERISTIC_IFACE, "StopNotify",
+                        callback=callback, error_callback=error_callback)
 
 class BLEService(DbusWrapper):
 
+    __slots__ = ()
+
     @property
     def characteristics(self):
         for k, v in self.list_children_info():
-            yield BLECharacteristic(BLUEZ_BUS, k, bus=self.bus)
+            yield BLECharacteristic.for_path(BLUEZ_BUS, k, self.bus)
 
 
 class BLEDevice(DbusWrapper):
 
+    __slots__ = ("_char_index", "_char_index_sub")
+
+    def __init__(self, *args, **kwargs):
+        super(BLEDevice, self).__init__(*args, **kwargs)
+        # UUID -> BLECharacteristic, valid while the services stay resolved
+        self._char_index = None
+        self._char_index_sub = None
+
+    def _char_index_changed(self, name, changed, lst):
+        if not changed.get("Connected", True) or \
+                not changed.get("ServicesResolved", True) or \
+                "UUIDs" in changed:
+            self._char_index = None
+
+    def _build_char_index(self):
+        index = {}
+        for k, v in self.mirror.descendants(self.object_path, depth=None):
+            if GATT_CHARACTERISTIC_IFACE in v:
+                uuid = v[GATT_CHARACTERISTIC_IFACE]["UUID"]
+                index[uuid] = BLECharacteristic.for_path(BLUEZ_BUS, k,
+                                                         self.bus)
+        return index
+
+    def invalidate_char_index(self):
+        self._char_index = None
+
+    def connect_async(self, callback=None, error_callback=None):
+        self.call_async(DEVICE_IFACE, "Connect",
+                        callback=callback, error_callback=error_callback)
+
+    def disconnect_async(self, callback=None, error_callback=None):
+        self.call_async(DEVICE_IFACE, "Disconnect",
+                        callback=callback, error_callback=error_callback)
+
     @property
     def services(self):
         for k, v in self.list_children_info():
-            yield BLEService(BLUEZ_BUS, k, bus=self.bus)
+            yield BLEService.for_path(BLUEZ_BUS, k, self.bus)
 
     @property
     def characteristics(self):
@@ -74,14 +398,25 @@ class BLEDevice(DbusWrapper):
                 yield char
 
     def char_by_uuid(self, uuid):
-        for c in self.characteristics:
-            if c.uuid == uuid:
-                return c
+        index = self._char_index
+        if index is None:
+            if self._char_index_sub is None:
+                self._char_index_sub = \
+                    self.properties_changed.connect(self._char_index_changed)
+            index = self._build_char_index()
+            # Only keep the index if the GATT tree is complete, otherwise we
+            # would cache a partial view of the device
+            if self.services_resolved:
+                self._char_index = index
+        if uuid in index:
+            return index[uuid]
         raise IOError("UUID '%s' not present on the device" % uuid)
 
 
 class BLE(DbusWrapper):
 
+    __slots__ = ()
+
     def __init__(self, controller=None):
         if controller is None:
             # TODO: Add actual auto controller selection
@@ -89,12 +424,12 @@ class BLE(DbusWrapper):
         super(BLE, self).__init__(BLUEZ_BUS, "/org/bluez/" + controller)
 
     def device_by_address(self, address):
-        for dev in self.devices:
-            if dev.address == address:
-                return dev
+        for k, v in self.list_children_info():
+            if v.get(DEVICE_IFACE, {}).get("Address") == address:
+                return BLEDevice.for_path(BLUEZ_BUS, k, self.bus)
         raise IOError("Device with address %s not found" % address)
 
     @property
     def devices(self):
         for k, v in self.list_children_info():
-            yield BLEDevice(BLUEZ_BUS, k, bus=self.bus)
+            yield BLEDevice.for_path(BLUEZ_BUS, k, self.bus)
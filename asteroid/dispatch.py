@@ -0,0 +1,98 @@
+import collections
+import functools
+import logging
+from asteroid import bleee, metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Handlers registered with this are called on every change of the property
+ANY = object()
+
+property_changes = metrics.REGISTRY.counter(
+    "asteroid_property_changes_total",
+    "Device property changes received from BlueZ")
+property_dispatches = metrics.REGISTRY.counter(
+    "asteroid_property_dispatches_total",
+    "Handler calls made for device property changes")
+
+
+def handles(prop, to=ANY):
+    """
+    Marks a module method as handler(asteroid, value) for changes of the
+    device property prop, or only for the ones to the value to
+    """
+    def decorator(fn):
+        fn.__dict__.setdefault("_handles", []).append((prop, to))
+        return fn
+    return decorator
+
+
+class PropertyDispatcher:
+    """
+    Routes the PropertiesChanged signals of the watches to the handlers
+    registered for the property, with a single subscription per device.
+    Handlers can ask for a transition to a specific value, which only fires
+    when the value actually differs from the previous one.
+    """
+
+    def __init__(self):
+        # (property, value or ANY) -> [handler]
+        self._handlers = collections.defaultdict(list)
+        self._subscriptions = {}
+        # Last seen device properties, to detect transitions
+        self._last = {}
+
+    def watch(self, asteroid):
+        if asteroid in self._subscriptions:
+            return
+        dev = asteroid.dev
+        self.seed(asteroid, dev.mirror.objects.get(dev.object_path, {})
+                                              .get(bleee.DEVICE_IFACE, {}))
+        self._subscriptions[asteroid] = dev.properties_changed.connect(
+                                    functools.partial(self._dispatch, asteroid))
+
+    def unwatch(self, asteroid):
+        subscription = self._subscriptions.pop(asteroid, None)
+        if subscription is not None:
+            subscription.disconnect()
+        self._last.pop(asteroid, None)
+
+    def seed(self, asteroid, props):
+        """ Sets the values which the next changes are compared against """
+        self._last[asteroid] = dict(props)
+
+    def on(self, prop, handler, to=ANY):
+        self._handlers[(prop, to)].append(handler)
+
+    def off(self, prop, handler, to=ANY):
+        self._handlers[(prop, to)].remove(handler)
+
+    def _dispatch(self, asteroid, iface, changed, invalidated):
+        if iface == bleee.DEVICE_IFACE:
+            self.dispatch(asteroid, changed, invalidated)
+
+    def dispatch(self, asteroid, changed, invalidated=()):
+        """ Runs the handlers for the changed device properties """
+        last = self._last.setdefault(asteroid, {})
+        for prop, value in changed.items():
+            property_changes.inc(property=prop)
+            old = last.get(prop, bleee._MISSING)
+            last[prop] = value
+            handlers = list(self._handlers.get((prop, ANY), ()))
+            try:
+                if old != value:
+                    handlers.extend(self._handlers.get((prop, value), ()))
+            except TypeError:
+                # Unhashable values (arrays, dicts) can only be watched as a
+                # whole
+                pass
+            for handler in handlers:
+                property_dispatches.inc(property=prop)
+                try:
+                    handler(asteroid, value)
+                except Exception:
+                    logger.exception("Handler %r for %s failed" %
+                                     (handler, prop))
+        for prop in invalidated:
+            last.pop(prop, None)
@@ -0,0 +1,382 @@
+"""
+Runs a module in a worker process of its own (App.register_module(module,
+isolate=True)), so that a module which blocks or crashes can not hold up
+the event loop of the main process.
+
+The worker re-creates the module from its class and config and hands it
+stand-ins for App and the watches. Writes (notify, update_*) and media
+listener registrations are forwarded to the main process, device property
+changes and media commands come back the other way. Isolated modules are
+therefore limited to that part of the API, which covers the notification,
+weather and MPD modules, but not e.g. ReconnectModule.
+"""
+
+import functools
+import importlib
+import logging
+import os
+import pickle
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+from asteroid.dispatch import PropertyDispatcher
+from asteroid.scheduler import QueueFull
+from gi.repository import GLib
+
+
+logger = logging.getLogger(__name__)
+
+# Methods of Asteroid which the worker may call
+FORWARDED = ("notify", "update_media", "update_weather", "update_time")
+
+LENGTH = struct.Struct("<I")
+
+
+class Channel:
+    """
+    Length prefixed pickles over a non-blocking socket, driven by the GLib
+    loop. Sending never blocks, messages are buffered up to max_buffer bytes
+    and dropped beyond that.
+    """
+
+    def __init__(self, sock, on_message, on_close, max_buffer=1 << 20):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.on_message = on_message
+        self.on_close = on_close
+        self.max_buffer = max_buffer
+        self.dropped = 0
+        self._in = bytearray()
+        self._out = bytearray()
+        self._out_id = None
+        self._in_id = GLib.io_add_watch(
+                        sock.fileno(), GLib.PRIORITY_DEFAULT,
+                        GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._readable)
+
+    def send(self, message):
+        if self.sock is None:
+            return
+        data = pickle.dumps(message)
+        if len(self._out) + len(data) > self.max_buffer:
+            self.dropped += 1
+            return
+        self._out += LENGTH.pack(len(data)) + data
+        self._flush()
+
+    def _flush(self):
+        try:
+            sent = self.sock.send(self._out)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close()
+            return False
+        del self._out[:sent]
+        if self._out and self._out_id is None:
+            self._out_id = GLib.io_add_watch(
+                                self.sock.fileno(), GLib.PRIORITY_DEFAULT,
+                                GLib.IO_OUT, self._writable)
+        return bool(self._out)
+
+    def _writable(self, fd, condition):
+        more = self._flush()
+        if not more:
+            self._out_id = None
+        return more
+
+    def _readable(self, fd, condition):
+        try:
+            data = self.sock.recv(1 << 16)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b""
+        if not data:
+            self._in_id = None
+            self.close()
+            return False
+        self._in += data
+        while len(self._in) >= LENGTH.size:
+            length, = LENGTH.unpack_from(self._in)
+            if len(self._in) < LENGTH.size + length:
+                break
+            message = pickle.loads(self._in[LENGTH.size:LENGTH.size + length])
+            del self._in[:LENGTH.size + length]
+            self.on_message(message)
+        return True
+
+    def close(self):
+        if self.sock is None:
+            return
+        for source_id in (self._in_id, self._out_id):
+            if source_id is not None:
+                GLib.source_remove(source_id)
+        self._in_id = self._out_id = None
+        self.sock.close()
+        self.sock = None
+        self.on_close()
+
+
+class ModuleProcess:
+    """
+    The main process' end of an isolated module. A worker which dies is
+    restarted, waiting restart_base seconds, doubled after every worker which
+    did not last restart_reset seconds, up to restart_max.
+    """
+
+    def __init__(self, app, module, restart_base=1, restart_max=300,
+                 restart_reset=60):
+        self.app = app
+        self.module = module
+        self.name = type(module).__name__
+        self.restart_base = restart_base
+        self.restart_max = restart_max
+        self.restart_reset = restart_reset
+        self.restarts = 0
+        self._failures = 0
+        self._started = None
+        self._restart_id = None
+        self._stopped = False
+        self.process = None
+        self.channel = None
+        # Addresses with a media listener, which outlive the workers
+        self._listening = set()
+        # The worker always gets to know about the connection state, and
+        # about everything the module has handlers for
+        self.props = {"Connected", "ServicesResolved"} | \
+            {prop for prop, _, _ in type(module)._property_handlers}
+        self._spawn()
+        for prop in self.props:
+            app.dispatcher.on(prop, functools.partial(self._property, prop))
+
+    def _spawn(self):
+        parent, child = socket.socketpair()
+        # The worker has to find the package wherever it was imported from
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+                                    os.path.abspath(p) for p in sys.path))
+        self.process = subprocess.Popen(
+            [sys.executable, "-m", "asteroid.isolation", str(child.fileno())],
+            pass_fds=(child.fileno(),), env=env)
+        child.close()
+        # Reaped from the loop, waiting for the worker could block it
+        GLib.child_watch_add(GLib.PRIORITY_DEFAULT, self.process.pid,
+                             self._reaped, self.process)
+        self._started = time.monotonic()
+        self.channel = Channel(parent, self._message,
+                               functools.partial(self._closed, self.process))
+        states = {
+            ast.address: {prop: ast.dev.mirror.get_property(
+                                    ast.dev.object_path, prop, None)
+                          for prop in self.props}
+            for ast in self.app.asteroids
+        }
+        self.channel.send(("start", type(self.module).__module__,
+                           type(self.module).__qualname__, self.module.config,
+                           states, logging.getLogger().level))
+
+    def _property(self, prop, asteroid, value):
+        self.channel.send(("property", asteroid.address, prop, value))
+
+    def _media_command(self, asteroid, command):
+        self.channel.send(("media", asteroid.address, command))
+
+    def _message(self, message):
+        kind, address = message[:2]
+        try:
+            asteroid = self.app.asteroid_by_address(address)
+        except KeyError:
+            return
+        if kind == "call":
+            method, args, kwargs = message[2:]
+            if method not in FORWARDED:
+                logger.warning("%s called %s, which is not forwarded" %
+                               (self.name, method))
+                return
+            try:
+                getattr(asteroid, method)(*args, **kwargs)
+            except (QueueFull, IOError) as e:
+                logger.warning("%s of %s on %s failed with %r" %
+                               (method, self.name, address, e))
+            self.channel.send(("full", address, asteroid.scheduler.full))
+        elif kind == "listen" and address not in self._listening:
+            try:
+                asteroid.register_media_listener(
+                    functools.partial(self._media_command, asteroid))
+            except IOError as e:
+                logger.warning("Media listener of %s on %s failed with %r" %
+                               (self.name, address, e))
+                return
+            self._listening.add(address)
+
+    def _closed(self, process):
+        # A worker we can not talk to is of no use, the restart follows once
+        # it is reaped
+        if process.returncode is None:
+            process.terminate()
+
+    def _reaped(self, pid, status, process):
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if self._stopped or process is not self.process:
+            return
+        if time.monotonic() - self._started > self.restart_reset:
+            self._failures = 0
+        delay = min(self.restart_base * 2 ** self._failures, self.restart_max)
+        self._failures += 1
+        logger.error("Worker process of %s exited with %s, restarting it in "
+                     "%d seconds" % (self.name, process.returncode, delay))
+        self._restart_id = GLib.timeout_add(int(delay * 1000), self._restart)
+
+    def _restart(self):
+        self._restart_id = None
+        self.restarts += 1
+        self.channel.close()
+        self._spawn()
+        return False
+
+    def stop(self):
+        self._stopped = True
+        if self._restart_id is not None:
+            GLib.source_remove(self._restart_id)
+            self._restart_id = None
+        self.channel.close()
+
+
+class _Subscription:
+
+    def __init__(self, listeners, fn):
+        self.listeners = listeners
+        self.fn = fn
+
+    def disconnect(self):
+        if self.fn in self.listeners:
+            self.listeners.remove(self.fn)
+
+
+class RemoteDevice:
+
+    def __init__(self, props):
+        self.props = props
+
+    @property
+    def connected(self):
+        return bool(self.props.get("Connected"))
+
+    @property
+    def services_resolved(self):
+        return bool(self.props.get("ServicesResolved"))
+
+
+class RemoteScheduler:
+
+    def __init__(self):
+        self.full = False
+
+
+class RemoteAsteroid:
+    """ Stands in for an Asteroid of the main process inside the worker """
+
+    def __init__(self, channel, address, props):
+        self.channel = channel
+        self.address = address
+        self.dev = RemoteDevice(props)
+        self.scheduler = RemoteScheduler()
+        self.media_listeners = []
+
+    def _call(self, method, *args, **kwargs):
+        self.channel.send(("call", self.address, method, args, kwargs))
+
+    def notify(self, summary, body=None, id_=None, package_name=None,
+               app_name=None, app_icon=None, force=False, max_bytes=None,
+               callback=None, error_callback=None):
+        # The id has to be known right away
+        if id_ is None:
+            id_ = random.randint(0, 2 ** 31)
+        id_ = str(id_)
+        self._call("notify", summary, body, id_, package_name, app_name,
+                   app_icon, force=force, max_bytes=max_bytes)
+        # The outcome of the write stays in the main process
+        if callback:
+            callback()
+        return id_
+
+    def update_media(self, *args, **kwargs):
+        self._call("update_media", *args, **kwargs)
+
+    def update_weather(self, *args, **kwargs):
+        self._call("update_weather", *args, **kwargs)
+
+    def update_time(self, *args, **kwargs):
+        self._call("update_time", *args, **kwargs)
+
+    def register_media_listener(self, fn):
+        if not self.media_listeners:
+            self.channel.send(("listen", self.address))
+        self.media_listeners.append(fn)
+        return _Subscription(self.media_listeners, fn)
+
+
+class Worker:
+    """ Stands in for App inside the worker process """
+
+    def __init__(self, sock):
+        self.loop = GLib.MainLoop()
+        self.channel = Channel(sock, self._message, self.loop.quit)
+        self.dispatcher = PropertyDispatcher()
+        self.asteroids = []
+        self.asteroid = None
+        self.module = None
+        self.modules = []
+
+    def asteroid_by_address(self, address):
+        for ast in self.asteroids:
+            if ast.address == address:
+                return ast
+        raise KeyError(address)
+
+    def _start(self, module_name, class_name, config, states, log_level):
+        from asteroid.app import LogFormatter
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(LogFormatter())
+        logging.getLogger().addHandler(handler)
+        logging.getLogger().setLevel(log_level)
+        for address, props in states.items():
+            ast = RemoteAsteroid(self.channel, address, props)
+            self.dispatcher.seed(ast, props)
+            self.asteroids.append(ast)
+        self.asteroid = self.asteroids[0]
+        class_ = functools.reduce(getattr, class_name.split("."),
+                                  importlib.import_module(module_name))
+        self.module = class_(**config)
+        self.module.register(self)
+        self.modules.append(self.module)
+
+    def _message(self, message):
+        kind = message[0]
+        if kind == "start":
+            self._start(*message[1:])
+            return
+        ast = self.asteroid_by_address(message[1])
+        if kind == "property":
+            prop, value = message[2:]
+            ast.dev.props[prop] = value
+            self.dispatcher.dispatch(ast, {prop: value})
+        elif kind == "media":
+            for fn in list(ast.media_listeners):
+                fn(message[2])
+        elif kind == "full":
+            ast.scheduler.full = message[2]
+
+    def run(self):
+        self.loop.run()
+
+
+def main():
+    sock = socket.socket(fileno=int(sys.argv[1]))
+    Worker(sock).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import collections
+import json
+import logging
+import os
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    """
+    Writes which could not be delivered because the watch was away, kept as
+    JSON lines on disk so that they also survive restarts. The journal is
+    compacted to the latest value of every characteristic plus the
+    max_notifications most recent notifications.
+    """
+
+    Entry = collections.namedtuple(
+                "Entry", ["uuid", "data", "priority", "key", "time"])
+
+    def __init__(self, path, max_notifications=16):
+        self.path = path
+        self.max_notifications = max_notifications
+        self._entries = collections.OrderedDict()
+        self._lines = 0
+        self._load()
+
+    @staticmethod
+    def default_path(address):
+        base = os.environ.get("XDG_STATE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".local", "state")
+        return os.path.join(base, "asteroid",
+                            "journal-%s.jsonl" % address.replace(":", ""))
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _encode(entry):
+        return json.dumps({"uuid": entry.uuid, "data": entry.data.hex(),
+                           "priority": entry.priority, "key": entry.key,
+                           "time": entry.time})
+
+    @staticmethod
+    def _decode(line):
+        obj = json.loads(line)
+        key = obj["key"]
+        # Notification keys are (uuid, id) tuples, which JSON turns into lists
+        if isinstance(key, list):
+            key = tuple(key)
+        return Journal.Entry(uuid=obj["uuid"], data=bytes.fromhex(obj["data"]),
+                             priority=obj["priority"], key=key,
+                             time=obj["time"])
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except OSError:
+            return
+        for line in lines:
+            try:
+                self._add(self._decode(line))
+            except (ValueError, KeyError, TypeError):
+                # Most likely a line cut short by a crash
+                logger.warning("Skipping corrupt journal line in %s" %
+                               self.path)
+        self._lines = len(lines)
+
+    def _add(self, entry):
+        self._entries.pop(entry.key, None)
+        self._entries[entry.key] = entry
+        if isinstance(entry.key, tuple):
+            notifications = [k for k in self._entries if isinstance(k, tuple)]
+            for k in notifications[:-self.max_notifications or None]:
+                del self._entries[k]
+
+    def append(self, uuid, data, priority, key=None):
+        entry = Journal.Entry(uuid=uuid, data=bytes(data), priority=priority,
+                              key=uuid if key is None else key,
+                              time=time.time())
+        self._add(entry)
+        if self._lines > 2 * len(self._entries):
+            self._rewrite()
+            return
+        self._makedirs()
+        with open(self.path, "a") as f:
+            f.write(self._encode(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._lines += 1
+
+    def _makedirs(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+
+    def _rewrite(self):
+        self._makedirs()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for entry in self._entries.values():
+                f.write(self._encode(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._lines = len(self._entries)
+
+    def drain(self):
+        """ Removes and returns all entries, ordered by priority and age """
+        entries = sorted(self._entries.values(),
+                         key=lambda e: (e.priority, e.time))
+        self._entries.clear()
+        self._rewrite()
+        return entries
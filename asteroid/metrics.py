@@ -0,0 +1,233 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from gi.repository import GLib
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+class Metric:
+
+    TYPE = None
+
+    def __init__(self, name, help_):
+        self.name = name
+        self.help = help_
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.extend(self._render_value(labels, value))
+        return lines
+
+    def _render_value(self, labels, value):
+        return ["%s%s %s" % (self.name, _format_labels(labels), value)]
+
+
+class Counter(Metric):
+
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    """ Gauge whose value is computed by fn(**labels) at render time """
+
+    TYPE = "gauge"
+
+    def __init__(self, name, help_, fn):
+        super(Gauge, self).__init__(name, help_)
+        self.fn = fn
+
+    def track(self, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = None
+
+    def render(self):
+        with self._lock:
+            keys = list(self._values.keys())
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.TYPE)]
+        for labels in sorted(keys):
+            lines.extend(self._render_value(labels, self.fn(**dict(labels))))
+        return lines
+
+
+class Histogram(Metric):
+
+    TYPE = "histogram"
+
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                       0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, name, help_, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Per-bucket counts including +Inf, then the sum
+                counts = self._values[key] = [0] * (len(self.buckets) + 2)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def totals(self):
+        """ Returns {labels: (count, sum)} """
+        with self._lock:
+            return {labels: (sum(counts[:-1]), counts[-1])
+                    for labels, counts in self._values.items()}
+
+    def _render_value(self, labels, counts):
+        ret = []
+        total = 0
+        for le, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            ret.append("%s_bucket%s %d" % (
+                self.name, _format_labels(labels + (("le", le),)), total))
+        ret.append("%s_count%s %d" % (self.name, _format_labels(labels), total))
+        ret.append("%s_sum%s %f" % (self.name, _format_labels(labels),
+                                    counts[-1]))
+        return ret
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, class_, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = class_(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name, help_):
+        return self._get(Counter, name, help_)
+
+    def gauge(self, name, help_, fn):
+        return self._get(Gauge, name, help_, fn)
+
+    def histogram(self, name, help_, buckets=Histogram.DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help_, buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = [self._metrics[k] for k in sorted(self._metrics)]
+        return "\n".join(line for m in metrics for line in m.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+gatt_seconds = REGISTRY.histogram(
+    "asteroid_gatt_operation_seconds",
+    "Latency of GATT characteristic operations")
+gatt_errors = REGISTRY.counter(
+    "asteroid_gatt_errors_total",
+    "Failed GATT characteristic operations")
+gatt_bytes_written = REGISTRY.counter(
+    "asteroid_gatt_bytes_written_total",
+    "Bytes written to GATT characteristics")
+connect_seconds = REGISTRY.histogram(
+    "asteroid_connect_seconds",
+    "Time from a connection attempt until the services are resolved")
+connect_attempts = REGISTRY.counter(
+    "asteroid_connect_attempts_total",
+    "Connection attempts")
+connect_errors = REGISTRY.counter(
+    "asteroid_connect_errors_total",
+    "Failed connection attempts")
+handler_seconds = REGISTRY.histogram(
+    "asteroid_module_handler_seconds",
+    "Time spent in module callbacks")
+handler_cpu_seconds = REGISTRY.histogram(
+    "asteroid_module_handler_cpu_seconds",
+    "CPU time spent in module callbacks")
+handler_errors = REGISTRY.counter(
+    "asteroid_module_handler_errors_total",
+    "Exceptions raised from module callbacks")
+
+
+# Thread id -> labels of the module callback it is running
+running_handlers = {}
+
+
+def timed_handler(fn):
+    """ Records the run time and exceptions of a module callback """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        labels = {"module": type(self).__name__, "handler": fn.__name__}
+        thread = threading.get_ident()
+        outer = running_handlers.get(thread)
+        running_handlers[thread] = labels
+        start = time.monotonic()
+        start_cpu = time.thread_time()
+        try:
+            return fn(self, *args, **kwargs)
+        except Exception:
+            handler_errors.inc(**labels)
+            raise
+        finally:
+            if outer is None:
+                del running_handlers[thread]
+            else:
+                running_handlers[thread] = outer
+            handler_seconds.observe(time.monotonic() - start, **labels)
+            handler_cpu_seconds.observe(time.thread_time() - start_cpu,
+                                        **labels)
+    return wrapper
+
+
+class TextfileExporter:
+    """
+    Periodically writes the registry in the Prometheus text format, e.g. for
+    the node_exporter textfile collector. The file is replaced atomically.
+    """
+
+    def __init__(self, path, interval=15, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._source_id = None
+
+    def start(self):
+        self.write()
+        self._source_id = GLib.timeout_add_seconds(self.interval, self.write)
+
+    def stop(self):
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(self.registry.render())
+        os.replace(tmp, self.path)
+        return True
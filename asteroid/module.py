@@ -1,14 +1,24 @@
 
+import collections
+import functools
+import itertools
+import json
+import os
 import time
 import logging
-import queue
+import random
 import threading
-import mpd
-import pyowm
 import pydbus as dbus
-from asteroid import Asteroid, DBusEavesdropper, WeatherPredictions
+from asteroid import Asteroid, DBusEavesdropper, LazyModule, \
+    WeatherPredictions, bleee, metrics
+from asteroid.dispatch import handles
+from asteroid.scheduler import QueueFull
 from gi.repository import GLib
 
+# Only imported once a module which needs them gets instantiated
+mpd = LazyModule("mpd")
+pyowm = LazyModule("pyowm")
+
 
 def merge_dicts(first, second):
     """ Recursively deep merges two dictionaries """
@@ -25,6 +35,11 @@ class MetaModule(type):
 
     def __init__(self, name, bases, dict_):
         self.logger = logging.getLogger(name)
+        # (property, value, method name) of the methods marked with
+        # dispatch.handles, inherited ones included
+        self._property_handlers = [
+            (prop, to, attr) for attr in dir(self)
+            for prop, to in getattr(getattr(self, attr), "_handles", ())]
 
 
 class Module(metaclass=MetaModule):
@@ -36,128 +51,531 @@ class Module(metaclass=MetaModule):
 
     def register(self, app):
         self.app = app
+        self.asteroids = app.asteroids
+        # The first watch, for modules which only care about one
         self.asteroid = app.asteroid
-        self.asteroid.dev.properties_changed.connect(self._properties_changed)
-
-    def _properties_changed(self, name, changed, lst):
-        pass
+        for prop, to, attr in self._property_handlers:
+            app.dispatcher.on(prop, getattr(self, attr), to=to)
 
 
 class TimeSyncModule(Module):
 
     def register(self, app):
         super(TimeSyncModule, self).register(app)
-        # We want to do this on startup, but as the dbus-is-blocking issues is
-        # not solved yet, be careful
-        if self.asteroid.dev.connected:
-            self._update_time()
+        for asteroid in self.asteroids:
+            if asteroid.dev.connected:
+                self._update_time(asteroid)
 
-    def _update_time(self):
-        self.asteroid.update_time()
-        self.logger.info("Time synchronized")
+    def _update_time(self, asteroid):
+        try:
+            asteroid.update_time()
+        except QueueFull:
+            self.logger.warn("Write queue of %s full, time not synchronized" %
+                             asteroid.address)
+            return
+        self.logger.info("Time synchronized on %s" % asteroid.address)
 
-    def _properties_changed(self, name, changed, lst):
-        if changed.get("Connected", False):
-            self._update_time()
+    @handles("Connected", to=True)
+    @metrics.timed_handler
+    def _on_connected(self, asteroid, value):
+        self._update_time(asteroid)
 
 
 class ReconnectModule(Module):
+    """
+    Reconnects to the watches when they go away, with exponential backoff
+    (randomized by jitter) between failed attempts. An attempt is started
+    right away when BlueZ sees the watch again, i.e. on RSSI updates during
+    discovery or when the device object reappears.
+    """
 
     defconfig = {"timeout_base": 5,
                  "timeout_max": 300,
-                 "timeout_reset": 120}
+                 "timeout_reset": 120,
+                 "jitter": 0.2}
+
+    class State:
+
+        def __init__(self):
+            self.last_connected = 0.0
+            self.disconnected = None
+            self.failures = 0
+            self.timer_id = None
+            self.connecting = False
+            self.attempts = 0
+            self.reconnects = 0
+            self.reconnect_time = 0.0
+            self.reconnect_time_max = 0.0
 
     def __init__(self, **kwargs):
         super(ReconnectModule, self).__init__(**kwargs)
-        self._last_connected = 0.0
-        self._timeout = 0
-        self._condvar = threading.Condition()
-        self._thread = threading.Thread(target=self._reconnect_fn)
-        self._thread.daemon = True
+        self._states = {}
 
     def register(self, app):
         super(ReconnectModule, self).register(app)
-        self._thread.start()
-
-    def _reconnect_fn(self):
-        while True:
-            self._condvar.acquire()
-            while self.asteroid.dev.connected:
-                self._condvar.wait(10)
-            self._condvar.release()
-            dt = time.time() - self._last_connected
-            if dt > self.config["timeout_reset"]:
-                self._timeout = 0
-            if self._timeout > 0:
-                self.logger.info("Reconnecting in %d seconds..." % self._timeout)
-                time.sleep(self._timeout)
+        for asteroid in self.asteroids:
+            state = self._states[asteroid] = ReconnectModule.State()
+            if asteroid.dev.connected:
+                state.last_connected = time.monotonic()
             else:
-                self.logger.info("Reconnecting...")
-            self.asteroid.connect()
-            self._timeout = min(self._timeout + self.config["timeout_base"],
-                                self.config["timeout_max"])
-            self.logger.info("Connected!")
+                state.disconnected = time.monotonic()
+                self._schedule(asteroid, 0)
+        app.ble.bus.subscribe(sender=bleee.BLUEZ_BUS,
+                              iface=bleee.OBJECT_MANAGER_IFACE,
+                              signal="InterfacesAdded",
+                              signal_fired=self._interfaces_added)
+
+    def stats(self, asteroid):
+        state = self._states[asteroid]
+        return {
+            "attempts": state.attempts,
+            "reconnects": state.reconnects,
+            "time_to_reconnect_mean": (state.reconnect_time / state.reconnects
+                                       if state.reconnects else 0.0),
+            "time_to_reconnect_max": state.reconnect_time_max,
+        }
+
+    def _backoff(self, state):
+        if not state.failures:
+            return 0
+        timeout = min(self.config["timeout_base"] * 2 ** (state.failures - 1),
+                      self.config["timeout_max"])
+        jitter = self.config["jitter"]
+        return timeout * random.uniform(1 - jitter, 1 + jitter)
+
+    def _schedule(self, asteroid, delay):
+        state = self._states[asteroid]
+        if state.timer_id is not None:
+            GLib.source_remove(state.timer_id)
+        if delay > 0:
+            self.logger.info("Reconnecting to %s in %d seconds..." %
+                             (asteroid.address, delay))
+        state.timer_id = GLib.timeout_add(int(delay * 1000), self._attempt,
+                                          asteroid)
+
+    def _cancel(self, asteroid):
+        state = self._states[asteroid]
+        if state.timer_id is not None:
+            GLib.source_remove(state.timer_id)
+            state.timer_id = None
+
+    def _attempt(self, asteroid):
+        state = self._states[asteroid]
+        state.timer_id = None
+        if state.connecting or asteroid.dev.connected or \
+                asteroid.idle_disconnected:
+            return False
+        self.logger.info("Reconnecting to %s..." % asteroid.address)
+        state.connecting = True
+        state.attempts += 1
+        asteroid.connect_async(functools.partial(self._connected, asteroid),
+                               functools.partial(self._connect_failed, asteroid))
+        return False
 
-    def _properties_changed(self, name, changed, lst):
-        if not changed.get("Connected", True):
-            self._condvar.acquire()
-            self._condvar.notify()
-            self._condvar.release()
-        elif changed.get("Connected", False):
-            self._last_connected = time.time()
+    def _connected(self, asteroid):
+        self._states[asteroid].connecting = False
+        self.logger.info("Connected to %s!" % asteroid.address)
+
+    def _connect_failed(self, asteroid, error):
+        state = self._states[asteroid]
+        state.connecting = False
+        state.failures += 1
+        self.logger.warn("Connection attempt to %s failed with %s" %
+                         (asteroid.address, getattr(error, "message", error)))
+        if not asteroid.dev.connected:
+            self._schedule(asteroid, self._backoff(state))
+
+    def _seen(self, asteroid):
+        # BlueZ can see the watch, so there is no point in waiting any longer
+        state = self._states[asteroid]
+        if not asteroid.dev.connected and not state.connecting and \
+                state.timer_id is not None:
+            self._schedule(asteroid, 0)
+
+    def _interfaces_added(self, sender, path, iface, signal, params):
+        for asteroid in self.asteroids:
+            if params[0] == asteroid.dev.object_path:
+                self._seen(asteroid)
+
+    @handles("Connected", to=False)
+    @metrics.timed_handler
+    def _on_disconnected(self, asteroid, value):
+        if asteroid.idle_disconnected:
+            # We hung up ourselves, the next write reconnects
+            return
+        state = self._states[asteroid]
+        now = time.monotonic()
+        state.disconnected = now
+        # Reconnect right away after a connection which has been stable
+        # for a while, a flapping link counts as a failed attempt
+        if now - state.last_connected > self.config["timeout_reset"]:
+            state.failures = 0
+        else:
+            state.failures += 1
+        self._schedule(asteroid, self._backoff(state))
+
+    @handles("Connected", to=True)
+    @metrics.timed_handler
+    def _on_connected(self, asteroid, value):
+        state = self._states[asteroid]
+        now = time.monotonic()
+        state.last_connected = now
+        state.connecting = False
+        self._cancel(asteroid)
+        if state.disconnected is not None:
+            dt = now - state.disconnected
+            state.reconnects += 1
+            state.reconnect_time += dt
+            state.reconnect_time_max = max(state.reconnect_time_max, dt)
+            reconnect_seconds.observe(dt, address=asteroid.address)
+            state.disconnected = None
+
+    @handles("RSSI")
+    @metrics.timed_handler
+    def _on_rssi(self, asteroid, value):
+        self._seen(asteroid)
+
+
+reconnect_seconds = metrics.REGISTRY.histogram(
+    "asteroid_reconnect_seconds",
+    "Time from losing the connection to a watch until it was reestablished",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600))
+
+
+class LifecycleModule(Module):
+    """
+    Disconnects from the watches after disconnect_timeout seconds without
+    any writes, to save their battery. The next write reconnects, after
+    waiting batch_window seconds for more updates to go along with it.
+    Session statistics get logged every stats_interval seconds.
+    """
+
+    defconfig = {"disconnect_timeout": 60,
+                 "batch_window": 0.5,
+                 "stats_interval": 10 * 60}
+
+    def register(self, app):
+        super(LifecycleModule, self).register(app)
+        for asteroid in self.asteroids:
+            asteroid.disconnect_timeout = self.config["disconnect_timeout"]
+            asteroid.batch_window = self.config["batch_window"]
+            asteroid._touch()
+        if self.config["stats_interval"]:
+            GLib.timeout_add_seconds(self.config["stats_interval"],
+                                     self._log_stats)
+
+    @metrics.timed_handler
+    def _log_stats(self):
+        for asteroid in self.asteroids:
+            stats = asteroid.session_stats()
+            self.logger.info(
+                "%s: %d sessions (%d idle disconnects), %.1f writes per "
+                "session, connected %.0f%% of the time" %
+                (asteroid.address, stats["sessions"],
+                 stats["idle_disconnects"], stats["writes_per_session"],
+                 stats["duty_cycle"] * 100))
+        return True
 
 
 class NotifyModule(Module):
+    """
+    Forwards desktop notifications to the watch. Pending updates of the same
+    notification (by their replaces_id) are collapsed into one and the sending
+    is rate limited by a token bucket, with up to batch_size notifications
+    flushed at once. Notifications whose write fails get their token back and
+    are retried up to max_retries times.
+    """
+
+    defconfig = {"rate": 2.0,
+                 "burst": 5,
+                 "batch_size": 5,
+                 "max_pending": 64,
+                 "retry_delay": 200,
+                 "max_retries": 3}
 
     def register(self, app):
         super(NotifyModule, self).register(app)
-        self._pending = queue.Queue()
+        # The eavesdropper calls us from the GDBus worker thread
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        self._keys = itertools.count()
+        # Key -> number of failed sends
+        self._retries = collections.Counter()
+        self._flush_id = None
+        self._tokens = float(self.config["burst"])
+        self._tokens_time = time.monotonic()
+        self.counters = collections.Counter(
+                            received=0, coalesced=0, dropped=0, sent=0)
         self._eavesdropper = DBusEavesdropper(
                                     dbus.SessionBus(),
                                     "org.freedesktop.Notifications",
                                     "Notify",
                                     self._on_notification)
+        self.logger.debug("Capturing notifications %s" %
+                          ("as a monitor" if self._eavesdropper.monitoring
+                           else "by eavesdropping"))
+
+    def _schedule_flush(self, delay):
+        # Has to be called with the lock held
+        if self._flush_id is None:
+            self._flush_id = GLib.timeout_add(delay, self._flush)
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._tokens + (now - self._tokens_time) *
+                           self.config["rate"], self.config["burst"])
+        self._tokens_time = now
+
+    @metrics.timed_handler
+    def _flush(self):
+        with self._lock:
+            self._flush_id = None
+            if all(a.scheduler.full for a in self.asteroids):
+                # Let the write queue drain before pushing more into it
+                self._schedule_flush(self.config["retry_delay"])
+                return False
+            self._refill()
+            batch = []
+            while self._pending and self._tokens >= 1.0 and \
+                    len(batch) < self.config["batch_size"]:
+                batch.append(self._pending.popitem(last=False))
+                self._tokens -= 1.0
+            if self._pending:
+                wait = (1.0 - self._tokens) / self.config["rate"]
+                self._schedule_flush(max(int(wait * 1000), 1))
+        for key, (args, addresses) in batch:
+            self._notification_send(key, addresses, *args)
+        return False
 
-    def _notification_send(self):
-        try:
-            msg = self._pending.get_nowait()
-            app_name, id_, app_icon, summary, body, actions, hints, \
-                expiration = msg.get_body()
-            self.asteroid.notify(summary, body=body,
-                                 id_=(id_ if id_ else None),
-                                 app_name=app_name, app_icon=app_icon)
-            self.logger.info("Sent notification '%s'" % summary)
-        except queue.Empty:
-            pass
-        return bool(self._pending.qsize())
+    @metrics.timed_handler
+    def _notification_send(self, key, addresses, app_name, id_, app_icon,
+                           summary, body):
+        # All the watches get the same id, so that they can be updated later
+        # (and a retry replaces the notification instead of adding another)
+        id_ = str(id_) if id_ else str(random.randint(0, 2 ** 31))
+        args = (app_name, id_, app_icon, summary, body)
+        # Retries only go to the watches which failed before
+        asteroids = [a for a in self.asteroids
+                     if addresses is None or a.address in addresses]
+        fanout = _Fanout(len(asteroids),
+                         functools.partial(self._send_done, key, args))
+        for asteroid in asteroids:
+            report = functools.partial(fanout.result, asteroid.address)
+            try:
+                asteroid.notify(summary, body=body, id_=id_,
+                                app_name=app_name, app_icon=app_icon,
+                                callback=report, error_callback=report)
+            except QueueFull as e:
+                report(e)
+        self.logger.info("Sent notification '%s'" % summary)
+
+    def _send_done(self, key, args, failed, error):
+        with self._lock:
+            if not failed:
+                self.counters["sent"] += 1
+                self._retries.pop(key, None)
+                return
+            if key in self._pending:
+                # Superseded by a newer version, which goes to all watches
+                self._retries.pop(key, None)
+                return
+            self._retries[key] += 1
+            if self._retries[key] > self.config["max_retries"]:
+                del self._retries[key]
+                self.counters["dropped"] += 1
+                self.logger.warn("Dropped notification '%s' to %s: %s" %
+                                 (args[3], ", ".join(sorted(failed)), error))
+                return
+            # The token bought nothing, so give it back and go again
+            self._tokens = min(self._tokens + 1.0, self.config["burst"])
+            self._pending[key] = (args, failed)
+            self._pending.move_to_end(key, last=False)
+            self._schedule_flush(self.config["retry_delay"])
 
     def _on_notification(self, msg):
-        self._pending.put(msg)
-        GLib.idle_add(self._notification_send)
+        app_name, id_, app_icon, summary, body, actions, hints, \
+            expiration = msg.get_body()
+        with self._lock:
+            self.counters["received"] += 1
+            key = id_ if id_ else ("new", next(self._keys))
+            if key in self._pending:
+                self.counters["coalesced"] += 1
+            elif len(self._pending) >= self.config["max_pending"]:
+                self._pending.popitem(last=False)
+                self.counters["dropped"] += 1
+            # (arguments, addresses of the watches to send to or None for all)
+            self._pending[key] = ((app_name, id_, app_icon, summary, body),
+                                  None)
+            self._schedule_flush(0)
+
+
+class _Fanout:
+    """
+    Collects the outcome of sending one notification to several watches,
+    done(failed addresses, last error) is called once all of them reported
+    """
+
+    def __init__(self, count, done):
+        self.left = count
+        self.failed = set()
+        self.error = None
+        self.done = done
+
+    def result(self, address, error=None):
+        if error is not None:
+            self.failed.add(address)
+            self.error = error
+        self.left -= 1
+        if not self.left:
+            self.done(self.failed, self.error)
+
+
+class OWMProvider:
+    """ Fetches the forecast from OpenWeatherMap, this blocks """
+
+    def __init__(self, api_key, location):
+        pyowm._load()
+        self.api_key = api_key
+        self.location = location
+
+    def fetch(self):
+        owm = pyowm.OWM(self.api_key)
+        # TODO: Eventually, autodetecting the location would be nice
+        forecast = owm.daily_forecast(self.location).get_forecast()
+        return WeatherPredictions.from_owm(forecast)
+
+
+class WeatherCache:
+    """ Keeps the last forecast on disk, so that it survives restarts """
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def default_path():
+        base = os.environ.get("XDG_CACHE_HOME") or \
+            os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "asteroid", "weather.json")
+
+    def load(self):
+        """ Returns (fetch time, predictions) or None """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data["time"], WeatherPredictions.from_dict(data["forecast"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def store(self, predictions, time_=None):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"time": time.time() if time_ is None else time_,
+                       "forecast": predictions.to_dict()}, f)
+        os.replace(tmp, self.path)
 
 
 class OWMModule(Module):
+    """
+    Sends the weather forecast to the watches. The forecast is fetched in a
+    worker thread from the provider (OpenWeatherMap by default, anything with
+    a blocking fetch() returning WeatherPredictions can be passed as
+    "provider") and cached on disk for cache_ttl seconds.
+    """
+
+    defconfig = {"update_interval": 2 * 60 * 60,
+                 "cache_ttl": 6 * 60 * 60,
+                 "cache_path": None,
+                 "provider": None}
 
-    defconfig = {"update_interval": 2 * 60 * 60 }
+    def __init__(self, **kwargs):
+        super(OWMModule, self).__init__(**kwargs)
+        self.provider = self.config["provider"] or \
+            OWMProvider(self.config["api_key"], self.config["location"])
+        self.cache = WeatherCache(self.config["cache_path"] or
+                                  WeatherCache.default_path())
+        self._predictions = None
+        self._fetching = False
 
     def register(self, app):
         super(OWMModule, self).register(app)
+        age = None
+        cached = self.cache.load()
+        if cached is not None:
+            fetched, preds = cached
+            age = max(time.time() - fetched, 0)
+            if age < self.config["cache_ttl"]:
+                self.logger.info("Using cached forecast from %d minutes ago" %
+                                 (age // 60))
+                self._predictions = preds
+                self._send(self.asteroids)
+            else:
+                age = None
+        if age is None or age >= self.config["update_interval"]:
+            self._update_weather()
+            GLib.timeout_add_seconds(self.config["update_interval"],
+                                     self._update_weather)
+        else:
+            GLib.timeout_add_seconds(
+                int(self.config["update_interval"] - age) + 1,
+                self._first_update)
+
+    def _first_update(self):
         self._update_weather()
-        GLib.timeout_add_seconds(self.config["update_interval"], self._update_weather)
+        GLib.timeout_add_seconds(self.config["update_interval"],
+                                 self._update_weather)
+        return False
+
+    @handles("Connected", to=True)
+    @metrics.timed_handler
+    def _on_connected(self, asteroid, value):
+        if self._predictions is not None:
+            self._send([asteroid])
 
+    @metrics.timed_handler
     def _update_weather(self):
+        if not self._fetching:
+            self._fetching = True
+            thread = threading.Thread(target=self._fetch_fn)
+            thread.daemon = True
+            thread.start()
+        return True
+
+    def _fetch_fn(self):
         try:
-            owm = pyowm.OWM(self.config["api_key"])
-            # TODO: Eventually, autodetecting the location would be nice
-            forecast = owm.daily_forecast(self.config["location"]).get_forecast()
-            preds = WeatherPredictions.from_owm(forecast)
-            self.asteroid.update_weather(preds)
-            self.logger.info("Weather update sent")
+            preds = self.provider.fetch()
         except Exception as e:
+            GLib.idle_add(self._fetch_done, None, e)
+            return
+        GLib.idle_add(self._fetch_done, preds, None)
+
+    @metrics.timed_handler
+    def _fetch_done(self, preds, error):
+        self._fetching = False
+        if error is not None:
             # We can't str the exception directly, because a bug in PyOWM python3
             # support would lead to another exception
-            self.logger.error("Weather update failed with %s" % type(e))
-        return True
+            self.logger.error("Weather update failed with %s" % type(error))
+            return False
+        self._predictions = preds
+        try:
+            self.cache.store(preds)
+        except OSError as e:
+            self.logger.warn("Failed to cache the forecast: %r" % e)
+        self._send(self.asteroids)
+        return False
+
+    def _send(self, asteroids):
+        # One forecast serves all the watches
+        for asteroid in asteroids:
+            try:
+                asteroid.update_weather(self._predictions)
+                self.logger.info("Weather update sent to %s" % asteroid.address)
+            except QueueFull:
+                self.logger.warn("Write queue of %s full, weather update "
+                                 "dropped" % asteroid.address)
 
 
 class MPDModule(Module):
@@ -165,16 +583,52 @@ class MPDModule(Module):
     defconfig = {
         "host": "127.0.0.1",
         "port": 6600,
-        "reconnect_period": 5
+        "reconnect_period": 5,
+        # Only the state after a burst of changes (e.g. skipping through
+        # tracks) is sent to the watch
+        "debounce": 300,
+        "command_timeout": 3,
+        "command_backoff": 1,
+        "command_backoff_max": 60
     }
 
     def __init__(self, **kwargs):
         super(MPDModule, self).__init__(**kwargs)
         self._mpd_watch = self._make_mpd(connect=False)
-
-    def _properties_changed(self, name, changed, lst):
-        if changed.get("Connected", False):
-            self._send_update()
+        # Media commands from the watch go through a separate connection, as
+        # the other one spends its time in idle
+        self._mpd_command = self._make_mpd(connect=False)
+        self._mpd_command.timeout = self.config["command_timeout"]
+        self._command_connected = False
+        self._command_backoff = 0
+        self._command_retry_at = 0.0
+        self._commands = []
+        self._commands_id = None
+        self._listening = set()
+        self._idling = False
+        self._debounce_id = None
+
+    @handles("ServicesResolved", to=True)
+    @metrics.timed_handler
+    def _on_services_resolved(self, asteroid, value):
+        if asteroid not in self._listening:
+            self._register_listener(asteroid)
+
+    @handles("Connected", to=True)
+    @metrics.timed_handler
+    def _on_connected(self, asteroid, value):
+        # The watch has forgotten everything
+        self._send_update([asteroid])
+
+    def _register_listener(self, asteroid):
+        try:
+            asteroid.register_media_listener(self._command_cb)
+        except IOError as e:
+            # Retried once the services are resolved
+            self.logger.warn("Media listener registration on %s failed "
+                             "with %r" % (asteroid.address, e))
+            return
+        self._listening.add(asteroid)
 
     def _make_mpd(self, connect=True):
         cl = mpd.MPDClient()
@@ -185,7 +639,8 @@ class MPDModule(Module):
 
     def register(self, app):
         super(MPDModule, self).register(app)
-        self.asteroid.register_media_listener(self._command_cb)
+        for asteroid in self.asteroids:
+            self._register_listener(asteroid)
         GLib.timeout_add_seconds(self.config["reconnect_period"], self._mpd_reconnect)
 
     def _mpd_connection_error_cb(self, src=None, cond=None):
@@ -202,50 +657,157 @@ class MPDModule(Module):
         except mpd.ConnectionError:
             return False
         self.logger.info("MPD connected")
+        self._idling = False
         self._send_update()
-        self._mpd_watch.send_idle()
+        self._idle()
         GLib.io_add_watch(self._mpd_watch, GLib.IO_ERR | GLib.IO_HUP | GLib.IO_NVAL,
                           self._mpd_connection_error_cb)
         GLib.io_add_watch(self._mpd_watch, GLib.IO_IN, self._mpd_cb)
         return False
 
-    def _send_update(self):
-        try:
-            song = self._mpd_watch.currentsong()
-            status = self._mpd_watch.status()
-            self.asteroid.update_media(
-                song.get("title", "Unknown"),
+    # Subsystems which can change what the watch shows
+    IDLE_SUBSYSTEMS = ("player", "playlist")
+
+    def _idle(self):
+        self._mpd_watch.send_idle(*self.IDLE_SUBSYSTEMS)
+        self._idling = True
+
+    def _fetch_state(self):
+        # Commands can not be sent while waiting in idle, so interrupt it
+        # and go back afterwards
+        idling = self._idling
+        if idling:
+            self._mpd_watch.noidle()
+            self._idling = False
+        self._mpd_watch.command_list_ok_begin()
+        self._mpd_watch.currentsong()
+        self._mpd_watch.status()
+        song, status = self._mpd_watch.command_list_end()
+        if idling:
+            self._idle()
+        return (song.get("title", "Unknown"),
                 song.get("album", "Unknown"),
                 song.get("artist", "Unknown"),
-                status["state"] == "play"
-            )
-        except mpd.ConnectionError as e:
+                status["state"] == "play")
+
+    def _send_update(self, asteroids=None):
+        if asteroids is None:
+            asteroids = self.asteroids
+        try:
+            state = self._fetch_state()
+        except (mpd.ConnectionError, mpd.CommandError, OSError) as e:
             self.logger.warn("Attempt to update MPD status failed with %r" % e)
+            return
+        for asteroid in asteroids:
+            # Unchanged fields are skipped by the write shadow of Asteroid,
+            # which also knows whether the last write actually went through
+            try:
+                asteroid.update_media(*state)
+            except QueueFull:
+                self.logger.warn("Write queue of %s full, media update "
+                                 "dropped" % asteroid.address)
+
+    def _debounced_update(self):
+        self._debounce_id = None
+        self._send_update()
+        return False
 
+    @metrics.timed_handler
     def _mpd_cb(self, src, cond):
         try:
-            changes = self._mpd_watch.fetch_idle()
-            if "player" in changes:
-                self._send_update()
-            self._mpd_watch.send_idle()
+            self._idling = False
+            self._mpd_watch.fetch_idle()
+            self._idle()
         except (mpd.ConnectionError, mpd.PendingCommandError) as e:
             self.logger.warn("MPD idle fetch failed with %r" % e)
             return False
+        # Only the subsystems we care about wake us up
+        if self._debounce_id is not None:
+            GLib.source_remove(self._debounce_id)
+        self._debounce_id = GLib.timeout_add(self.config["debounce"],
+                                             self._debounced_update)
         return True
 
+    _COMMANDS = {
+        Asteroid.MEDIA_COMMAND_PREVIOUS: "previous",
+        Asteroid.MEDIA_COMMAND_NEXT: "next",
+        Asteroid.MEDIA_COMMAND_PLAY: "play",
+        Asteroid.MEDIA_COMMAND_PAUSE: "pause",
+    }
+
+    @metrics.timed_handler
     def _command_cb(self, cmd):
+        if cmd not in self._COMMANDS:
+            self.logger.error("Unknown media command code %02x" % cmd)
+            return
+        # Commands arriving in a burst are sent together from the idle handler
+        self._commands.append((self._COMMANDS[cmd], time.monotonic()))
+        if self._commands_id is None:
+            self._commands_id = GLib.idle_add(self._flush_commands)
+
+    def _command_connect(self):
+        now = time.monotonic()
+        if now < self._command_retry_at:
+            return False
         try:
-            mpd = self._make_mpd()
-            if cmd == Asteroid.MEDIA_COMMAND_PREVIOUS:
-                mpd.previous()
-            elif cmd == Asteroid.MEDIA_COMMAND_NEXT:
-                mpd.next()
-            elif cmd == Asteroid.MEDIA_COMMAND_PLAY:
-                mpd.play()
-            elif cmd == Asteroid.MEDIA_COMMAND_PAUSE:
-                mpd.pause()
-            else:
-                self.logger.error("Unknown media command code %02x" % cmd)
-            mpd.close()
-        except Exception as e:
-            self.logger.warn("Attempted to send media command %02x but failed with %r" % (cmd, e))
+            self._mpd_command.connect(self.config["host"], self.config["port"])
+        except (OSError, mpd.ConnectionError) as e:
+            self._command_backoff = min(
+                max(self._command_backoff * 2, self.config["command_backoff"]),
+                self.config["command_backoff_max"])
+            self._command_retry_at = now + self._command_backoff
+            self.logger.warn("MPD command connection failed with %r, retrying "
+                             "in %d seconds" % (e, self._command_backoff))
+            return False
+        self._command_backoff = 0
+        self._command_connected = True
+        return True
+
+    def _command_disconnect(self):
+        self._command_connected = False
+        try:
+            self._mpd_command.disconnect()
+        except (OSError, mpd.ConnectionError):
+            pass
+
+    def _send_commands(self, commands):
+        self._mpd_command.command_list_ok_begin()
+        for name, _ in commands:
+            getattr(self._mpd_command, name)()
+        self._mpd_command.command_list_end()
+
+    @metrics.timed_handler
+    def _flush_commands(self):
+        self._commands_id = None
+        commands, self._commands = self._commands, []
+        # MPD drops idle clients after a while, so a failure on a connection
+        # which has been open for some time gets one more chance
+        for attempt in range(2):
+            if not self._command_connected and not self._command_connect():
+                self.logger.warn("Dropped %d media command(s), MPD is not "
+                                 "reachable" % len(commands))
+                return False
+            try:
+                self._send_commands(commands)
+                break
+            except (OSError, mpd.ConnectionError) as e:
+                self.logger.warn("MPD command connection lost with %r" % e)
+                self._command_disconnect()
+            except mpd.CommandError as e:
+                self.logger.warn("Media command(s) %s failed with %r" %
+                                 (", ".join(n for n, _ in commands), e))
+                return False
+        else:
+            return False
+        now = time.monotonic()
+        for name, received in commands:
+            mpd_command_seconds.observe(now - received, command=name)
+        self.logger.debug("Sent media command(s) %s in %.1f ms" %
+                          (", ".join(n for n, _ in commands),
+                           (now - commands[0][1]) * 1000))
+        return False
+
+
+mpd_command_seconds = metrics.REGISTRY.histogram(
+    "asteroid_mpd_command_seconds",
+    "Time from a media button press on the watch until MPD accepted it")
@@ -0,0 +1,159 @@
+"""
+Records the D-Bus traffic between the library and BlueZ, together with the
+notifications captured by DBusEavesdropper, so that it can be replayed later
+(see benchmarks/replay.py).
+
+The log starts with MAGIC, followed by records made of a HEADER (seconds
+since the start of the recording, record kind, payload length) and a marshal
+encoded payload. Message bodies are stored as their GVariant type string and
+serialized data, so that they replay with exactly the same types.
+"""
+
+import marshal
+import struct
+import threading
+import time
+from asteroid import DBusEavesdropper, bleee
+from gi.repository import Gio, GLib
+
+
+MAGIC = b"ASTREC\x00\x01"
+HEADER = struct.Struct("<dBI")
+
+# (type string, data) of the GetManagedObjects reply at the start
+SNAPSHOT = 0
+# (serial, path, interface, member, type string, data)
+CALL = 1
+# (reply serial, type string, data)
+RETURN = 2
+# (reply serial, error name, type string, data)
+ERROR = 3
+# (path, interface, member, type string, data)
+SIGNAL = 4
+# (destination, path, interface, member, type string, data)
+EAVESDROP = 5
+
+
+def _body(msg):
+    body = msg.get_body()
+    if body is None:
+        return "", b""
+    return body.get_type_string(), body.get_data_as_bytes().get_data()
+
+
+def variant(type_string, data):
+    """ Turns a recorded body back into a GLib.Variant """
+    if not type_string:
+        return None
+    return GLib.Variant.new_from_bytes(GLib.VariantType.new(type_string),
+                                       GLib.Bytes.new(data), False)
+
+
+def read_log(path):
+    """ Yields the (time, kind, payload) records of a log """
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise IOError("%s is not a recording" % path)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            time_, kind, length = HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # Cut short, the recorder did not get to finish
+                return
+            yield time_, kind, marshal.loads(data)
+
+
+class Recorder:
+    """
+    Records all calls to bus_name made over con (the system bus by default),
+    their replies and the signals bus_name sends. The filter sees the
+    messages as they go over the wire, which covers the blocking pydbus
+    calls as well as DbusWrapper.call_async and the object mirror.
+    """
+
+    def __init__(self, path, con=None, bus_name=bleee.BLUEZ_BUS):
+        self.path = path
+        self.con = con if con is not None else \
+            Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+        self.bus_name = bus_name
+        self._file = None
+        self._lock = threading.Lock()
+        self._start = None
+        self._owner = None
+        self._calls = set()
+        self._filter_id = None
+
+    def _call_bus(self, method, args):
+        return self.con.call_sync(
+            "org.freedesktop.DBus", "/org/freedesktop/DBus",
+            "org.freedesktop.DBus", method, args, None,
+            Gio.DBusCallFlags.NONE, -1, None).unpack()
+
+    def start(self):
+        self._file = open(self.path, "wb")
+        self._file.write(MAGIC)
+        self._start = time.monotonic()
+        self._owner = self._call_bus("GetNameOwner",
+                                     GLib.Variant("(s)", (self.bus_name,)))[0]
+        snapshot = self.con.call_sync(
+            self.bus_name, "/", bleee.OBJECT_MANAGER_IFACE,
+            "GetManagedObjects", None, None, Gio.DBusCallFlags.NONE, -1, None)
+        self.record(SNAPSHOT, (snapshot.get_type_string(),
+                               snapshot.get_data_as_bytes().get_data()))
+        self._filter_id = self.con.add_filter(self._filter_func)
+        DBusEavesdropper.recorder = self
+
+    def stop(self):
+        if DBusEavesdropper.recorder is self:
+            DBusEavesdropper.recorder = None
+        if self._filter_id is not None:
+            self.con.remove_filter(self._filter_id)
+            self._filter_id = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def record(self, kind, payload):
+        data = marshal.dumps(payload)
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(HEADER.pack(time.monotonic() - self._start,
+                                         kind, len(data)) + data)
+
+    def record_eavesdropped(self, msg):
+        self.record(EAVESDROP, (msg.get_destination() or "", msg.get_path(),
+                                msg.get_interface(), msg.get_member()) +
+                               _body(msg))
+
+    def _filter_func(self, con, msg, incoming):
+        # This runs in the GDBus worker thread
+        type_ = msg.get_message_type()
+        if not incoming:
+            if type_ == Gio.DBusMessageType.METHOD_CALL and \
+                    msg.get_destination() in (self.bus_name, self._owner):
+                with self._lock:
+                    self._calls.add(msg.get_serial())
+                self.record(CALL, (msg.get_serial(), msg.get_path(),
+                                   msg.get_interface(), msg.get_member()) +
+                                  _body(msg))
+        elif type_ == Gio.DBusMessageType.SIGNAL:
+            if msg.get_sender() == self._owner:
+                self.record(SIGNAL, (msg.get_path(), msg.get_interface(),
+                                     msg.get_member()) + _body(msg))
+        elif type_ in (Gio.DBusMessageType.METHOD_RETURN,
+                       Gio.DBusMessageType.ERROR):
+            serial = msg.get_reply_serial()
+            with self._lock:
+                if serial not in self._calls:
+                    return msg
+                self._calls.discard(serial)
+            if type_ == Gio.DBusMessageType.ERROR:
+                self.record(ERROR, (serial, msg.get_error_name()) + _body(msg))
+            else:
+                self.record(RETURN, (serial,) + _body(msg))
+        return msg
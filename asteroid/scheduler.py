@@ -0,0 +1,160 @@
+import collections
+import time
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _chain(first, second):
+    if first is None or second is None:
+        return first or second
+    def chained(*args):
+        first(*args)
+        second(*args)
+    return chained
+
+
+class WriteScheduler:
+    """
+    Serializes the characteristic writes of a single device. Only one write
+    is in flight at any time, the pending ones are sent ordered by priority
+    and then by submission time. Submitting a write with the key of a
+    pending one replaces the pending data instead of queueing another write.
+    """
+
+    PRIORITY_NOTIFICATION = 0
+    PRIORITY_MEDIA = 1
+    PRIORITY_WEATHER = 2
+    PRIORITY_TIME = 2
+
+    _PRIORITIES = 3
+
+    Entry = collections.namedtuple(
+                "Entry", ["uuid", "data", "submitted", "callback",
+                          "error_callback"])
+
+    def __init__(self, writer, max_depth=32):
+        # writer(uuid, data, callback, error_callback) performs the write
+        self.writer = writer
+        self.max_depth = max_depth
+        self._queues = [collections.OrderedDict()
+                        for _ in range(self._PRIORITIES)]
+        self._in_flight = None
+        self._counters = collections.Counter()
+        self._max_depth_seen = 0
+        self._waits = [[0, 0.0, 0.0] for _ in range(self._PRIORITIES)]
+
+    @property
+    def depth(self):
+        return sum(len(q) for q in self._queues)
+
+    @property
+    def idle(self):
+        return self._in_flight is None and not self.depth
+
+    @property
+    def full(self):
+        return self.depth >= self.max_depth
+
+    def submit(self, uuid, data, priority, key=None, callback=None,
+               error_callback=None):
+        """
+        Queues a write. Raises QueueFull if the queue is at its maximum depth
+        and there is nothing of lower priority to make room for it.
+        callback is called once the data (or data which superseded it) has
+        been written, error_callback with the error if that fails or with
+        QueueFull if the write gets evicted from the queue.
+        """
+        if key is None:
+            key = uuid
+        queue = self._queues[priority]
+        self._counters["submitted"] += 1
+        if key in queue:
+            old = queue[key]
+            queue[key] = old._replace(
+                data=data,
+                callback=_chain(old.callback, callback),
+                error_callback=_chain(old.error_callback, error_callback))
+            self._counters["merged"] += 1
+            return
+        if self.full:
+            self._evict(priority)
+        queue[key] = WriteScheduler.Entry(uuid=uuid, data=data,
+                                          submitted=time.monotonic(),
+                                          callback=callback,
+                                          error_callback=error_callback)
+        self._max_depth_seen = max(self._max_depth_seen, self.depth)
+        self._dispatch()
+
+    def _evict(self, priority):
+        # Make room by dropping the newest write of the lowest priority class
+        for queue in reversed(self._queues[priority + 1:]):
+            if queue:
+                _, entry = queue.popitem(last=True)
+                self._counters["evicted"] += 1
+                if entry.error_callback:
+                    entry.error_callback(QueueFull("Evicted from the queue"))
+                return
+        self._counters["rejected"] += 1
+        raise QueueFull("Write queue is full (%d entries)" % self.depth)
+
+    def _dispatch(self):
+        if self._in_flight is not None:
+            return
+        for priority, queue in enumerate(self._queues):
+            if queue:
+                break
+        else:
+            return
+        _, entry = queue.popitem(last=False)
+        self._in_flight = entry
+        wait = time.monotonic() - entry.submitted
+        stat = self._waits[priority]
+        stat[0] += 1
+        stat[1] += wait
+        stat[2] = max(stat[2], wait)
+        try:
+            self.writer(entry.uuid, entry.data,
+                        self._write_done, self._write_failed)
+        except IOError as e:
+            self._write_failed(e)
+
+    def _write_done(self):
+        self._counters["written"] += 1
+        entry, self._in_flight = self._in_flight, None
+        if entry.callback:
+            entry.callback()
+        self._dispatch()
+
+    def _write_failed(self, error):
+        self._counters["failed"] += 1
+        entry, self._in_flight = self._in_flight, None
+        if entry.error_callback:
+            entry.error_callback(error)
+        self._dispatch()
+
+    def clear(self):
+        """ Drops all pending writes """
+        for queue in self._queues:
+            while queue:
+                _, entry = queue.popitem(last=False)
+                self._counters["evicted"] += 1
+                if entry.error_callback:
+                    entry.error_callback(QueueFull("Queue cleared"))
+
+    def stats(self):
+        ret = {k: self._counters[k] for k in
+               ("submitted", "merged", "evicted", "rejected",
+                "written", "failed")}
+        ret["depth"] = self.depth
+        ret["max_depth"] = self._max_depth_seen
+        ret["wait"] = {
+            priority: {
+                "count": count,
+                "mean": total / count if count else 0.0,
+                "max": max_,
+            }
+            for priority, (count, total, max_) in enumerate(self._waits)
+        }
+        return ret
@@ -0,0 +1,79 @@
+import array
+
+
+class SampleRing:
+    """
+    Fixed size ring buffer of (timestamp, value) samples, kept in two flat
+    arrays of doubles. Once full, the oldest samples get overwritten.
+    Timestamps are expected to be appended in increasing order.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._times = array.array("d", bytes(8 * capacity))
+        self._values = array.array("d", bytes(8 * capacity))
+        self._start = 0
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def _index(self, i):
+        return (self._start + i) % self.capacity
+
+    def append(self, timestamp, value):
+        i = self._index(self._len)
+        self._times[i] = timestamp
+        self._values[i] = value
+        if self._len < self.capacity:
+            self._len += 1
+        else:
+            self._start = self._index(1)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+        i = self._index(i)
+        return self._times[i], self._values[i]
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+    def latest(self):
+        return self[-1] if self._len else None
+
+    def _first_since(self, since):
+        # Binary search over the logical indices, which are sorted by time
+        lo, hi = 0, self._len
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._times[self._index(mid)] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def since(self, timestamp):
+        """ Returns the samples taken at or after timestamp """
+        return [self[i] for i in range(self._first_since(timestamp), self._len)]
+
+    def slope(self, since=None):
+        """
+        Least squares estimate of the change of the value per second, over
+        the samples taken at or after since. None with fewer than two
+        distinct timestamps.
+        """
+        samples = self.since(since) if since is not None else list(self)
+        n = len(samples)
+        if n < 2:
+            return None
+        mean_t = sum(t for t, _ in samples) / n
+        mean_v = sum(v for _, v in samples) / n
+        var = sum((t - mean_t) ** 2 for t, _ in samples)
+        if not var:
+            return None
+        cov = sum((t - mean_t) * (v - mean_v) for t, v in samples)
+        return cov / var
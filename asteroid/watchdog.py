@@ -0,0 +1,81 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from asteroid import metrics
+from gi.repository import GLib
+
+
+logger = logging.getLogger(__name__)
+
+loop_lag_seconds = metrics.REGISTRY.histogram(
+    "asteroid_loop_lag_seconds",
+    "How late the event loop dispatched a periodic timer")
+loop_stalls = metrics.REGISTRY.counter(
+    "asteroid_loop_stalls_total",
+    "Event loop stalls longer than the threshold, by the running callback")
+
+
+class LoopMonitor:
+    """
+    Measures the dispatch latency of the GLib loop with a periodic timer. A
+    watchdog thread notices when the timer is overdue by more than threshold
+    seconds and logs the module callback which is running (as far as
+    metrics.timed_handler knows) together with a sample of the loop thread's
+    stack, while the stall is still going on.
+    start() has to be called from the thread which runs the loop.
+    """
+
+    def __init__(self, threshold=0.25, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self._thread_id = None
+        self._source_id = None
+        self._expected = None
+        self._reported = False
+        self._stop = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        self._thread_id = threading.get_ident()
+        self._expected = time.monotonic() + self.interval
+        self._source_id = GLib.timeout_add(int(self.interval * 1000),
+                                           self._tick)
+        self._stop.clear()
+        self._watchdog = threading.Thread(target=self._watch,
+                                          name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._source_id is not None:
+            GLib.source_remove(self._source_id)
+            self._source_id = None
+
+    def _tick(self):
+        now = time.monotonic()
+        loop_lag_seconds.observe(max(now - self._expected, 0.0))
+        self._expected = now + self.interval
+        self._reported = False
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.threshold / 2):
+            lag = time.monotonic() - self._expected
+            if lag > self.threshold and not self._reported:
+                self._reported = True
+                self._report(lag)
+
+    def _report(self, lag):
+        labels = metrics.running_handlers.get(self._thread_id)
+        if labels is not None:
+            where = "%s.%s" % (labels["module"], labels["handler"])
+        else:
+            labels = {"module": "unknown", "handler": "unknown"}
+            where = "an unknown callback"
+        loop_stalls.inc(**labels)
+        frame = sys._current_frames().get(self._thread_id)
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        logger.warning("Event loop stalled for %.3f s in %s at:\n%s" %
+                       (lag, where, stack))
@@ -0,0 +1,420 @@
+#! /usr/bin/env python3
+"""
+Scriptable stand-in for the parts of org.bluez used by this library. It
+publishes one adapter with AsteroidOS devices, whose GATT services and
+characteristics appear once they are connected, just like on the real thing.
+
+Per-call latency and disconnect injection can be configured on the command
+line or at runtime through the org.asteroid.FakeBluez1 interface on "/".
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pydbus as dbus
+from pydbus.generic import signal
+from gi.repository import GLib
+
+from asteroid import Asteroid
+
+
+BLUEZ_BUS = "org.bluez"
+ADAPTER_PATH = "/org/bluez/hci0"
+
+# Property name -> D-Bus signature, for building the a{sv} dictionaries
+PROPERTY_TYPES = {
+    "Address": "s",
+    "Name": "s",
+    "Powered": "b",
+    "Connected": "b",
+    "ServicesResolved": "b",
+    "UUIDs": "as",
+    "RSSI": "n",
+    "Device": "o",
+    "Service": "o",
+    "Primary": "b",
+    "UUID": "s",
+    "Value": "ay",
+    "Notifying": "b",
+    "Flags": "as",
+}
+
+# Characteristic UUID -> (service UUID, flags)
+SERVICES = collections.OrderedDict([
+    ("0000180f-0000-1000-8000-00805f9b34fb", [Asteroid.UUID_BATTERY]),
+    ("00005071-0000-0000-0000-00a57e401d05", [Asteroid.UUID_TIME]),
+    ("00006071-0000-0000-0000-00a57e401d05", [Asteroid.UUID_SCREENSHOT_REQ,
+                                              Asteroid.UUID_SCREENSHOT_RESP]),
+    ("00007071-0000-0000-0000-00a57e401d05", [Asteroid.UUID_MEDIA_TITLE,
+                                              Asteroid.UUID_MEDIA_ALBUM,
+                                              Asteroid.UUID_MEDIA_ARTIST,
+                                              Asteroid.UUID_MEDIA_PLAY,
+                                              Asteroid.UUID_MEDIA_COMM]),
+    ("00008071-0000-0000-0000-00a57e401d05", [Asteroid.UUID_WEATHER_CITY,
+                                              Asteroid.UUID_WEATHER_IDS,
+                                              Asteroid.UUID_WEATHER_MINT,
+                                              Asteroid.UUID_WEATHER_MAXT]),
+    ("00009071-0000-0000-0000-00a57e401d05", [Asteroid.UUID_NOTIF_UPD]),
+])
+
+
+def variant_props(props):
+    return {k: GLib.Variant(PROPERTY_TYPES[k], v) for k, v in props.items()}
+
+
+class NotConnected(Exception):
+    pass
+
+
+class FakeObject:
+
+    PropertiesChanged = signal()
+
+    IFACE = None
+
+    def __init__(self, fake, path):
+        self.fake = fake
+        self.path = path
+        self._registration = None
+
+    def properties(self):
+        return {}
+
+    def interfaces(self):
+        return {self.IFACE: variant_props(self.properties())}
+
+    def set_property(self, name, value):
+        setattr(self, "_" + name, value)
+        self.PropertiesChanged(self.IFACE, {name: value}, [])
+
+    def register(self):
+        self._registration = self.fake.bus.register_object(
+                                            self.path, self, None)
+        self.fake.root.InterfacesAdded(self.path, self.interfaces())
+
+    def unregister(self):
+        if self._registration is not None:
+            self.fake.root.InterfacesRemoved(self.path,
+                                             list(self.interfaces().keys()))
+            self._registration.unregister()
+            self._registration = None
+
+
+class FakeCharacteristic(FakeObject):
+    """
+    <node>
+      <interface name="org.bluez.GattCharacteristic1">
+        <method name="ReadValue">
+          <arg name="options" type="a{sv}" direction="in"/>
+          <arg name="value" type="ay" direction="out"/>
+        </method>
+        <method name="WriteValue">
+          <arg name="value" type="ay" direction="in"/>
+          <arg name="options" type="a{sv}" direction="in"/>
+        </method>
+        <method name="StartNotify"/>
+        <method name="StopNotify"/>
+        <property name="UUID" type="s" access="read"/>
+        <property name="Service" type="o" access="read"/>
+        <property name="Value" type="ay" access="read"/>
+        <property name="Notifying" type="b" access="read"/>
+        <property name="Flags" type="as" access="read"/>
+      </interface>
+    </node>
+    """
+
+    IFACE = "org.bluez.GattCharacteristic1"
+
+    def __init__(self, fake, device, path, uuid, service_path):
+        super(FakeCharacteristic, self).__init__(fake, path)
+        self.device = device
+        self._UUID = uuid
+        self._Service = service_path
+        self._Value = b"\x64" if uuid == Asteroid.UUID_BATTERY else b""
+        self._Notifying = False
+
+    UUID = property(lambda self: self._UUID)
+    Service = property(lambda self: self._Service)
+    Value = property(lambda self: self._Value)
+    Notifying = property(lambda self: self._Notifying)
+    Flags = property(lambda self: ["read", "write", "notify"])
+
+    def properties(self):
+        return {"UUID": self.UUID, "Service": self.Service,
+                "Value": self.Value, "Notifying": self.Notifying,
+                "Flags": self.Flags}
+
+    def ReadValue(self, options):
+        self.fake.call("read", self.device)
+        return self._Value
+
+    def WriteValue(self, value, options):
+        self.fake.call("write", self.device)
+        self.fake.stats["bytes_written"] += len(value)
+        self._Value = bytes(value)
+
+    def StartNotify(self):
+        self.fake.call("start_notify", self.device)
+        self.set_property("Notifying", True)
+
+    def StopNotify(self):
+        self.fake.call("stop_notify", self.device)
+        self.set_property("Notifying", False)
+
+
+class FakeService(FakeObject):
+    """
+    <node>
+      <interface name="org.bluez.GattService1">
+        <property name="UUID" type="s" access="read"/>
+        <property name="Device" type="o" access="read"/>
+        <property name="Primary" type="b" access="read"/>
+      </interface>
+    </node>
+    """
+
+    IFACE = "org.bluez.GattService1"
+
+    def __init__(self, fake, path, uuid, device_path):
+        super(FakeService, self).__init__(fake, path)
+        self.UUID = uuid
+        self.Device = device_path
+        self.Primary = True
+
+    def properties(self):
+        return {"UUID": self.UUID, "Device": self.Device,
+                "Primary": self.Primary}
+
+
+class FakeDevice(FakeObject):
+    """
+    <node>
+      <interface name="org.bluez.Device1">
+        <method name="Connect"/>
+        <method name="Disconnect"/>
+        <property name="Address" type="s" access="read"/>
+        <property name="Name" type="s" access="read"/>
+        <property name="Connected" type="b" access="read"/>
+        <property name="ServicesResolved" type="b" access="read"/>
+        <property name="UUIDs" type="as" access="read"/>
+        <property name="RSSI" type="n" access="read"/>
+      </interface>
+    </node>
+    """
+
+    IFACE = "org.bluez.Device1"
+
+    def __init__(self, fake, path, address):
+        super(FakeDevice, self).__init__(fake, path)
+        self.Address = address
+        self.Name = "AsteroidOS"
+        self._Connected = False
+        self._ServicesResolved = False
+        self.RSSI = -60
+        self._gatt = []
+
+    Connected = property(lambda self: self._Connected)
+    ServicesResolved = property(lambda self: self._ServicesResolved)
+    UUIDs = property(lambda self: list(SERVICES.keys()))
+
+    def properties(self):
+        return {"Address": self.Address, "Name": self.Name,
+                "Connected": self.Connected,
+                "ServicesResolved": self.ServicesResolved,
+                "UUIDs": self.UUIDs, "RSSI": self.RSSI}
+
+    def Connect(self):
+        self.fake.stats["connect"] += 1
+        self.fake.delay("connect")
+        if self._Connected:
+            return
+        self.set_property("Connected", True)
+        for i, (suuid, cuuids) in enumerate(SERVICES.items()):
+            spath = "%s/service%04x" % (self.path, 0x10 * (i + 1))
+            service = FakeService(self.fake, spath, suuid, self.path)
+            service.register()
+            self._gatt.append(service)
+            for j, cuuid in enumerate(cuuids):
+                cpath = "%s/char%04x" % (spath, 0x10 * (i + 1) + j + 1)
+                char = FakeCharacteristic(self.fake, self, cpath, cuuid, spath)
+                char.register()
+                self._gatt.append(char)
+        self.set_property("ServicesResolved", True)
+
+    def Disconnect(self):
+        self.fake.stats["disconnect"] += 1
+        self.drop()
+
+    def drop(self):
+        if not self._Connected:
+            return
+        self.set_property("ServicesResolved", False)
+        for obj in reversed(self._gatt):
+            obj.unregister()
+        self._gatt = []
+        self.set_property("Connected", False)
+
+
+class FakeAdapter(FakeObject):
+    """
+    <node>
+      <interface name="org.bluez.Adapter1">
+        <property name="Address" type="s" access="read"/>
+        <property name="Powered" type="b" access="read"/>
+      </interface>
+    </node>
+    """
+
+    IFACE = "org.bluez.Adapter1"
+
+    def __init__(self, fake, path):
+        super(FakeAdapter, self).__init__(fake, path)
+        self.Address = "00:00:00:00:00:01"
+        self.Powered = True
+
+    def properties(self):
+        return {"Address": self.Address, "Powered": self.Powered}
+
+
+class FakeRoot:
+    """
+    <node>
+      <interface name="org.freedesktop.DBus.ObjectManager">
+        <method name="GetManagedObjects">
+          <arg name="objects" type="a{oa{sa{sv}}}" direction="out"/>
+        </method>
+        <signal name="InterfacesAdded">
+          <arg name="object" type="o"/>
+          <arg name="interfaces" type="a{sa{sv}}"/>
+        </signal>
+        <signal name="InterfacesRemoved">
+          <arg name="object" type="o"/>
+          <arg name="interfaces" type="as"/>
+        </signal>
+      </interface>
+      <interface name="org.asteroid.FakeBluez1">
+        <method name="Configure">
+          <arg name="key" type="s" direction="in"/>
+          <arg name="value" type="d" direction="in"/>
+        </method>
+        <method name="ForceDisconnect">
+          <arg name="address" type="s" direction="in"/>
+        </method>
+        <method name="GetStats">
+          <arg name="stats" type="a{st}" direction="out"/>
+        </method>
+        <method name="ResetStats"/>
+      </interface>
+    </node>
+    """
+
+    InterfacesAdded = signal()
+    InterfacesRemoved = signal()
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def GetManagedObjects(self):
+        return {obj.path: obj.interfaces() for obj in self.fake.objects()}
+
+    def Configure(self, key, value):
+        if key not in self.fake.config:
+            raise KeyError(key)
+        self.fake.config[key] = value
+
+    def ForceDisconnect(self, address):
+        self.fake.device_by_address(address).drop()
+
+    def GetStats(self):
+        return dict(self.fake.stats)
+
+    def ResetStats(self):
+        self.fake.stats.clear()
+
+
+class FakeBluez:
+
+    def __init__(self, bus, addresses, **config):
+        self.bus = bus
+        self.config = {
+            "connect_latency": 0.0,
+            "read_latency": 0.0,
+            "write_latency": 0.0,
+            "start_notify_latency": 0.0,
+            "stop_notify_latency": 0.0,
+            # Probability of losing the connection on each GATT call
+            "disconnect_rate": 0.0,
+        }
+        self.config.update(config)
+        self.stats = collections.Counter()
+        self.root = FakeRoot(self)
+        self.adapter = FakeAdapter(self, ADAPTER_PATH)
+        self.devices = [
+            FakeDevice(self, "%s/dev_%s" % (ADAPTER_PATH,
+                                            addr.replace(":", "_")), addr)
+            for addr in addresses
+        ]
+
+    def objects(self):
+        yield self.adapter
+        for dev in self.devices:
+            yield dev
+            for obj in dev._gatt:
+                yield obj
+
+    def device_by_address(self, address):
+        for dev in self.devices:
+            if dev.Address == address:
+                return dev
+        raise KeyError(address)
+
+    def delay(self, op):
+        latency = self.config[op + "_latency"]
+        if latency:
+            time.sleep(latency)
+
+    def call(self, op, device):
+        self.stats[op] += 1
+        self.delay(op)
+        if not device.Connected:
+            raise NotConnected("Not connected")
+        if random.random() < self.config["disconnect_rate"]:
+            self.stats["injected_disconnect"] += 1
+            device.drop()
+            raise NotConnected("Connection lost")
+
+    def publish(self):
+        self.bus.register_object("/", self.root, None)
+        self.adapter.register()
+        for dev in self.devices:
+            dev.register()
+        self.bus.request_name(BLUEZ_BUS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("addresses", nargs="+",
+                        help="Addresses of the fake watches")
+    parser.add_argument("--connect-latency", type=float, default=0.0)
+    parser.add_argument("--read-latency", type=float, default=0.0)
+    parser.add_argument("--write-latency", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeBluez(dbus.SystemBus(), args.addresses,
+                     connect_latency=args.connect_latency,
+                     read_latency=args.read_latency,
+                     write_latency=args.write_latency,
+                     disconnect_rate=args.disconnect_rate)
+    fake.publish()
+    GLib.MainLoop().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,378 @@
+#! /usr/bin/env python3
+"""
+Replays a recording made with asteroid.recorder (App(record_path=...))
+against App and its modules on a private D-Bus bus, at real or accelerated
+speed, and prints per-handler CPU time and end-to-end latency as JSON.
+
+A stand-in org.bluez, running in a separate process, serves the recorded
+object tree, emits the recorded signals and captured notifications on their
+original schedule (divided by --speed) and answers method calls with the
+recorded replies, in order, after their recorded latency.
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from gi.repository import Gio, GLib
+
+from asteroid import recorder
+from run import git_commit, run_until, start_bus, summarize, wait_for_name
+
+CONTROL_IFACE = "org.asteroid.Replay1"
+PROPERTIES_IFACE = "org.freedesktop.DBus.Properties"
+INTROSPECTABLE_IFACE = "org.freedesktop.DBus.Introspectable"
+
+PROPERTIES_XML = """
+  <interface name="org.freedesktop.DBus.Properties">
+    <method name="Get">
+      <arg type="s" direction="in"/>
+      <arg type="s" direction="in"/>
+      <arg type="v" direction="out"/>
+    </method>
+    <method name="GetAll">
+      <arg type="s" direction="in"/>
+      <arg type="a{sv}" direction="out"/>
+    </method>
+    <signal name="PropertiesChanged">
+      <arg type="s"/>
+      <arg type="a{sv}"/>
+      <arg type="as"/>
+    </signal>
+  </interface>
+"""
+
+
+def interface_xml():
+    """ Interface name -> introspection XML, taken from the fake BlueZ """
+    import fakebluez
+    ret = {}
+    for class_ in (fakebluez.FakeCharacteristic, fakebluez.FakeService,
+                   fakebluez.FakeDevice, fakebluez.FakeAdapter,
+                   fakebluez.FakeRoot):
+        for iface in ET.fromstring(class_.__doc__):
+            ret[iface.get("name")] = ET.tostring(iface, encoding="unicode")
+    return ret
+
+
+def a_sv(value):
+    """ a{sv} GLib.Variant -> {name: GLib.Variant}, keeping the types """
+    return {value.get_child_value(i).get_child_value(0).get_string():
+            value.get_child_value(i).get_child_value(1).get_variant()
+            for i in range(value.n_children())}
+
+
+def load(path):
+    snapshot = None
+    timeline = []
+    calls = {}
+    # (path, interface, member) -> [(latency, kind, payload)]
+    replies = collections.defaultdict(collections.deque)
+    for time_, kind, payload in recorder.read_log(path):
+        if kind == recorder.SNAPSHOT:
+            snapshot = recorder.variant(*payload)
+        elif kind == recorder.CALL:
+            calls[payload[0]] = (time_, payload[1:4])
+        elif kind in (recorder.RETURN, recorder.ERROR):
+            call = calls.pop(payload[0], None)
+            if call is not None:
+                replies[call[1]].append((time_ - call[0], kind, payload[1:]))
+        elif kind in (recorder.SIGNAL, recorder.EAVESDROP):
+            timeline.append((time_, kind, payload))
+    if snapshot is None:
+        raise IOError("%s does not contain a snapshot" % path)
+    return snapshot, timeline, replies
+
+
+class ReplayServer:
+
+    def __init__(self, path, speed, grace, stats_path):
+        self.speed = speed
+        self.grace = grace
+        self.stats_path = stats_path
+        snapshot, self.timeline, self.replies = load(path)
+        self.objects = {}
+        objects = snapshot.get_child_value(0)
+        for i in range(objects.n_children()):
+            entry = objects.get_child_value(i)
+            self._add(entry.get_child_value(0).get_string(),
+                      entry.get_child_value(1))
+        self.interfaces = interface_xml()
+        self._last = {}
+        self._next = 0
+        self._started = None
+        self._last_event = None
+        self.latencies = []
+        self.stats = collections.Counter()
+        self.loop = GLib.MainLoop()
+        self.con = Gio.bus_get_sync(Gio.BusType.SYSTEM, None)
+
+    def _add(self, path, ifaces):
+        obj = self.objects.setdefault(path, {})
+        for i in range(ifaces.n_children()):
+            entry = ifaces.get_child_value(i)
+            obj[entry.get_child_value(0).get_string()] = \
+                a_sv(entry.get_child_value(1))
+
+    def _apply(self, path, iface, member, body):
+        if iface == "org.freedesktop.DBus.ObjectManager":
+            target = body.get_child_value(0).get_string()
+            if member == "InterfacesAdded":
+                self._add(target, body.get_child_value(1))
+            elif member == "InterfacesRemoved":
+                obj = self.objects.get(target, {})
+                for name in body.get_child_value(1).unpack():
+                    obj.pop(name, None)
+                if not obj:
+                    self.objects.pop(target, None)
+        elif iface == PROPERTIES_IFACE and member == "PropertiesChanged":
+            props = self.objects.get(path, {}).get(
+                        body.get_child_value(0).get_string())
+            if props is not None:
+                props.update(a_sv(body.get_child_value(1)))
+                for name in body.get_child_value(2).unpack():
+                    props.pop(name, None)
+
+    def _introspect(self, path):
+        ifaces = list(self.objects.get(path, {}))
+        if path == "/":
+            ifaces.append("org.freedesktop.DBus.ObjectManager")
+        return "<node>%s%s</node>" % (
+            PROPERTIES_XML,
+            "".join(self.interfaces.get(i, "") for i in ifaces))
+
+    def start(self):
+        for name in ("org.bluez", "org.freedesktop.Notifications"):
+            self.con.call_sync(
+                "org.freedesktop.DBus", "/org/freedesktop/DBus",
+                "org.freedesktop.DBus", "RequestName",
+                GLib.Variant("(su)", (name, 0)), None,
+                Gio.DBusCallFlags.NONE, -1, None)
+        self.con.add_filter(self._filter_func)
+        self.loop.run()
+
+    def _filter_func(self, con, msg, incoming):
+        if incoming and \
+                msg.get_message_type() == Gio.DBusMessageType.METHOD_CALL:
+            GLib.idle_add(self._handle_call, msg)
+            return None
+        return msg
+
+    def _reply(self, msg, type_string, value):
+        if msg.get_flags() & Gio.DBusMessageFlags.NO_REPLY_EXPECTED:
+            return
+        reply = Gio.DBusMessage.new_method_reply(msg)
+        if value is not None:
+            reply.set_body(value if type_string is None
+                           else GLib.Variant(type_string, value))
+        self.con.send_message(reply, Gio.DBusSendMessageFlags.NONE)
+
+    def _error(self, msg, name, text):
+        reply = Gio.DBusMessage.new_method_error_literal(msg, name, text)
+        self.con.send_message(reply, Gio.DBusSendMessageFlags.NONE)
+
+    def _handle_call(self, msg):
+        path, iface, member = \
+            msg.get_path(), msg.get_interface(), msg.get_member()
+        body = msg.get_body()
+        self.stats[member] += 1
+        if iface == INTROSPECTABLE_IFACE:
+            self._reply(msg, "(s)", (self._introspect(path),))
+        elif iface == PROPERTIES_IFACE and member == "Get":
+            name_iface, name = body.unpack()
+            value = self.objects.get(path, {}).get(name_iface, {}).get(name)
+            if value is None:
+                self._error(msg, "org.freedesktop.DBus.Error.InvalidArgs",
+                            "No such property %s" % name)
+            else:
+                self._reply(msg, "(v)", (value,))
+        elif iface == PROPERTIES_IFACE and member == "GetAll":
+            self._reply(msg, "(a{sv})", (
+                self.objects.get(path, {}).get(body.unpack()[0], {}),))
+        elif member == "GetManagedObjects":
+            self._reply(msg, "(a{oa{sa{sv}}})", (self.objects,))
+        elif iface == CONTROL_IFACE and member == "Start":
+            self._reply(msg, None, None)
+            self._started = time.monotonic()
+            self._schedule()
+        elif iface == "org.freedesktop.Notifications":
+            # Our own injected notifications
+            pass
+        else:
+            self._replay_reply(msg, (path, iface, member))
+        return False
+
+    def _replay_reply(self, msg, key):
+        if key[2] == "WriteValue" and self._last_event is not None:
+            self.latencies.append(time.monotonic() - self._last_event)
+        queue = self.replies.get(key)
+        if queue:
+            reply = self._last[key] = queue.popleft()
+        elif key in self._last:
+            # Ran out of recorded replies, keep repeating the last one
+            reply = self._last[key]
+        else:
+            self.stats["unmatched"] += 1
+            self._error(msg, "org.bluez.Error.NotSupported",
+                        "Not in the recording")
+            return
+        latency, kind, payload = reply
+        def send():
+            if kind == recorder.ERROR:
+                error, type_string, data = payload
+                text = recorder.variant(type_string, data)
+                self._error(msg, error,
+                            text.unpack()[0] if text is not None else "")
+            else:
+                self._reply(msg, None, recorder.variant(*payload))
+            return False
+        GLib.timeout_add(int(latency / self.speed * 1000), send)
+
+    def _schedule(self):
+        if self._next >= len(self.timeline):
+            GLib.timeout_add(int(self.grace * 1000), self._finish)
+            return
+        due = self._started + self.timeline[self._next][0] / self.speed
+        GLib.timeout_add(max(0, int((due - time.monotonic()) * 1000)),
+                              self._emit)
+
+    def _emit(self):
+        now = time.monotonic() - self._started
+        while self._next < len(self.timeline) and \
+                self.timeline[self._next][0] / self.speed <= now:
+            _, kind, payload = self.timeline[self._next]
+            self._next += 1
+            self._last_event = time.monotonic()
+            self.stats["events"] += 1
+            if kind == recorder.SIGNAL:
+                path, iface, member, type_string, data = payload
+                body = recorder.variant(type_string, data)
+                self._apply(path, iface, member, body)
+                self.con.emit_signal(None, path, iface, member, body)
+            else:
+                dest, path, iface, member, type_string, data = payload
+                msg = Gio.DBusMessage.new_method_call(
+                        dest or None, path, iface, member)
+                msg.set_body(recorder.variant(type_string, data))
+                msg.set_flags(Gio.DBusMessageFlags.NO_REPLY_EXPECTED)
+                self.con.send_message(msg,
+                                      Gio.DBusSendMessageFlags.NONE)
+        self._schedule()
+        return False
+
+    def _finish(self):
+        with open(self.stats_path, "w") as f:
+            json.dump({
+                "calls": dict(self.stats),
+                "end_to_end": summarize(self.latencies)
+                              if self.latencies else None,
+            }, f)
+        self.loop.quit()
+        return False
+
+
+def addresses(path):
+    snapshot = next(recorder.variant(*p) for _, k, p in recorder.read_log(path)
+                    if k == recorder.SNAPSHOT)
+    return [ifaces["org.bluez.Device1"]["Address"]
+            for ifaces in snapshot.unpack()[0].values()
+            if "org.bluez.Device1" in ifaces]
+
+
+def handler_report():
+    from asteroid import metrics
+    cpu = metrics.handler_cpu_seconds.totals()
+    wall = metrics.handler_seconds.totals()
+    ret = collections.OrderedDict()
+    for labels in sorted(wall):
+        d = dict(labels)
+        count, wall_total = wall[labels]
+        cpu_total = cpu.get(labels, (0, 0.0))[1]
+        ret["%s.%s" % (d["module"], d["handler"])] = {
+            "calls": count,
+            "cpu_s": cpu_total,
+            "wall_s": wall_total,
+            "cpu_mean_us": cpu_total / count * 1e6 if count else None,
+        }
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("log", help="Recording to replay")
+    parser.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Replay this many times faster")
+    parser.add_argument("--grace", type=float, default=2.0,
+                        help="Seconds to keep running after the last event")
+    parser.add_argument("-o", "--output", help="Write the results here")
+    parser.add_argument("--serve", metavar="STATS",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        ReplayServer(args.log, args.speed, args.grace, args.serve).start()
+        return
+
+    bus_proc = start_bus()
+    server = None
+    fd, stats_path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        import pydbus as dbus
+        bus = dbus.SystemBus()
+        server = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                   args.log, "--speed", str(args.speed),
+                                   "--grace", str(args.grace),
+                                   "--serve", stats_path])
+        wait_for_name(bus, "org.bluez")
+
+        import asteroid.app
+        from asteroid.module import NotifyModule, ReconnectModule, \
+            TimeSyncModule
+        app = asteroid.app.App(addresses(args.log), journal=False)
+        app.register_module(ReconnectModule())
+        app.register_module(TimeSyncModule())
+        app.register_module(NotifyModule(rate=1e6, burst=1e6))
+        start = time.monotonic()
+        bus.con.call_sync("org.bluez", "/", CONTROL_IFACE, "Start", None, None,
+                          Gio.DBusCallFlags.NONE, -1, None)
+        run_until(lambda: server.poll() is not None, timeout=None)
+        elapsed = time.monotonic() - start
+        with open(stats_path) as f:
+            server_stats = json.load(f)
+        report = {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "config": vars(args),
+            "elapsed_s": elapsed,
+            "bluez": server_stats,
+            "handlers": handler_report(),
+        }
+    finally:
+        if server is not None and server.poll() is None:
+            server.terminate()
+        bus_proc.terminate()
+        os.unlink(stats_path)
+
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
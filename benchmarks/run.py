@@ -0,0 +1,243 @@
+#! /usr/bin/env python3
+"""
+Runs the benchmarks against the fake BlueZ service on a private D-Bus bus
+and prints the results as JSON, so that they can be compared across commits.
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+ADDRESS = "43:43:A0:12:1F:AC"
+
+
+def start_bus():
+    proc = subprocess.Popen(["dbus-daemon", "--session", "--nofork",
+                             "--print-address"],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    address = proc.stdout.readline().strip()
+    # Everything in this process and its children talks to the private bus
+    os.environ["DBUS_SYSTEM_BUS_ADDRESS"] = address
+    os.environ["DBUS_SESSION_BUS_ADDRESS"] = address
+    return proc
+
+
+def start_fake(args):
+    cmd = [sys.executable, os.path.join(ROOT, "benchmarks", "fakebluez.py"),
+           "--connect-latency", str(args.connect_latency),
+           "--read-latency", str(args.read_latency),
+           "--write-latency", str(args.write_latency),
+           ADDRESS]
+    return subprocess.Popen(cmd)
+
+
+def wait_for_name(bus, name, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not bus.dbus.NameHasOwner(name):
+        if time.monotonic() > deadline:
+            raise RuntimeError("%s did not appear on the bus" % name)
+        time.sleep(0.05)
+
+
+def run_until(cond, timeout=30):
+    from gi.repository import GLib
+    ctx = GLib.MainContext.default()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while not cond():
+        if deadline is not None and time.monotonic() > deadline:
+            raise RuntimeError("Timed out")
+        ctx.iteration(False) or time.sleep(0.0005)
+
+
+def write_queue_idle(asteroid):
+    return lambda: asteroid.scheduler.idle
+
+
+def summarize(samples, ops=1):
+    samples = sorted(samples)
+    total = sum(samples)
+    return {
+        "n": len(samples),
+        "total_s": total,
+        "mean_us": statistics.mean(samples) * 1e6,
+        "p50_us": samples[len(samples) // 2] * 1e6,
+        "p95_us": samples[int(len(samples) * 0.95)] * 1e6,
+        "max_us": samples[-1] * 1e6,
+        "ops_per_s": len(samples) * ops / total if total else None,
+    }
+
+
+def timed(fn, n):
+    samples = []
+    for i in range(n):
+        t = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - t)
+    return samples
+
+
+class FakeMessage:
+
+    def __init__(self, body):
+        self._body = body
+
+    def get_body(self):
+        return self._body
+
+
+def bench_char_by_uuid(app, control, n):
+    from asteroid import Asteroid
+    dev = app.asteroid.dev
+    uuids = [Asteroid.UUID_NOTIF_UPD, Asteroid.UUID_MEDIA_TITLE,
+             Asteroid.UUID_WEATHER_MAXT, Asteroid.UUID_BATTERY]
+    return summarize(timed(lambda i: dev.char_by_uuid(uuids[i % len(uuids)]),
+                           n))
+
+
+def bench_notify(app, control, n):
+    ast = app.asteroid
+    def notify(i):
+        ast.notify("Summary %d" % i, body="Body of notification %d" % i,
+                   app_name="bench")
+        run_until(write_queue_idle(ast))
+    return summarize(timed(notify, n))
+
+
+def bench_update_media(app, control, n):
+    ast = app.asteroid
+    def update(i):
+        ast.update_media("Title %d" % i, "Album %d" % (i // 10),
+                         "Artist", i % 2 == 0)
+        run_until(write_queue_idle(ast))
+    return summarize(timed(update, n))
+
+
+def bench_update_weather(app, control, n):
+    from asteroid import WeatherPredictions
+    ast = app.asteroid
+    def update(i):
+        preds = WeatherPredictions("City %d" % i)
+        for x in range(WeatherPredictions.MAX_LEN):
+            preds.append_prediction(800 + x, 270 + i % 10, 290 + i % 10)
+        ast.update_weather(preds)
+        run_until(write_queue_idle(ast))
+    return summarize(timed(update, n))
+
+
+def bench_reconnect(app, control, n):
+    ast = app.asteroid
+    def reconnect(i):
+        control.ForceDisconnect(ast.address)
+        run_until(lambda: not ast.dev.connected)
+        done = []
+        ast.connect_async(lambda: done.append(True),
+                          lambda e: done.append(e))
+        run_until(lambda: done)
+    return summarize(timed(reconnect, n))
+
+
+def bench_module_events(app, control, n):
+    from asteroid.module import NotifyModule, TimeSyncModule
+    ast = app.asteroid
+    timesync = next(m for m in app.modules if isinstance(m, TimeSyncModule))
+    notify = next(m for m in app.modules if isinstance(m, NotifyModule))
+    def event(i):
+        timesync._on_connected(ast, True)
+        notify._on_notification(FakeMessage(
+            ("bench", 0, "", "Event %d" % i, "Body", [], {}, -1)))
+        run_until(lambda: not notify._pending and write_queue_idle(ast)())
+    return summarize(timed(event, n))
+
+
+BENCHMARKS = collections.OrderedDict([
+    ("char_by_uuid", bench_char_by_uuid),
+    ("notify", bench_notify),
+    ("update_media", bench_update_media),
+    ("update_weather", bench_update_weather),
+    ("reconnect", bench_reconnect),
+    ("module_events", bench_module_events),
+])
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    parser.add_argument("-o", "--output", help="Write the results here")
+    parser.add_argument("-b", "--benchmark", action="append",
+                        choices=list(BENCHMARKS.keys()),
+                        help="Run only the given benchmark(s)")
+    parser.add_argument("--connect-latency", type=float, default=0.0)
+    parser.add_argument("--read-latency", type=float, default=0.0)
+    parser.add_argument("--write-latency", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    bus_proc = start_bus()
+    fake_proc = None
+    try:
+        import pydbus as dbus
+        bus = dbus.SystemBus()
+        fake_proc = start_fake(args)
+        wait_for_name(bus, "org.bluez")
+        control = bus.get("org.bluez", "/")
+
+        import asteroid.app
+        from asteroid.module import NotifyModule, ReconnectModule, \
+            TimeSyncModule
+        # Keep benchmark writes out of the journal of the real watch
+        app = asteroid.app.App(ADDRESS, journal=False)
+        # Writes wait for the reconnect schedule after injected disconnects
+        app.register_module(ReconnectModule(timeout_base=0.1))
+        app.register_module(TimeSyncModule())
+        app.register_module(NotifyModule(rate=1e6, burst=1e6))
+        done = []
+        app.asteroid.connect_async(lambda: done.append(True))
+        run_until(lambda: done)
+        # Only inject disconnects once we are up
+        control.Configure("disconnect_rate", args.disconnect_rate)
+
+        results = collections.OrderedDict()
+        for name in args.benchmark or BENCHMARKS.keys():
+            control.ResetStats()
+            results[name] = BENCHMARKS[name](app, control, args.iterations)
+            results[name]["bluez_calls"] = control.GetStats()
+        report = {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "config": vars(args),
+            "results": results,
+        }
+    finally:
+        if fake_proc is not None:
+            fake_proc.terminate()
+        bus_proc.terminate()
+
+    out = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+
+if __name__ == "__main__":
+    main()
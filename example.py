@@ -19,6 +19,7 @@ parser.add_argument(
 
 args = parser.parse_args()
 
+# Can also be a list of addresses, to serve multiple watches at once
 ADDRESS = "43:43:A0:12:1F:AC"
 OWM_KEY = "XXXXXXXXXXXXXXXXXXXXXXXX"
 OWM_LOCATION = "Prague"
@@ -32,7 +33,12 @@ app.register_module(OWMModule(api_key=OWM_KEY, location=OWM_LOCATION))
 app.register_module(MPDModule())
 
 if args.interactive:
-    import IPython
-    IPython.embed()
+    app.logger.info(app.startup_report())
+    from IPython.terminal.embed import InteractiveShellEmbed
+    shell = InteractiveShellEmbed()
+    # Writes only go out from the event loop, which does not run in here, so
+    # run it after every command until they are through
+    shell.events.register("post_run_cell", lambda *args: app.flush())
+    shell()
 else:
     app.run()
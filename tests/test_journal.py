@@ -0,0 +1,71 @@
+from asteroid.journal import Journal
+
+
+def test_survives_reload(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.append("time", b"\x01", 2)
+    journal.append("notif", b"<insert/>", 0, key=("notif", "1"))
+    entries = Journal(path).drain()
+    assert [(e.uuid, e.data, e.key) for e in entries] == \
+        [("notif", b"<insert/>", ("notif", "1")), ("time", b"\x01", "time")]
+
+
+def test_keeps_latest_per_key(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    journal.append("title", b"a", 1)
+    journal.append("title", b"b", 1)
+    assert len(journal) == 1
+    assert journal.drain()[0].data == b"b"
+
+
+def test_limits_notifications(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"), max_notifications=2)
+    journal.append("time", b"", 2)
+    for i in range(5):
+        journal.append("notif", str(i).encode(), 0, key=("notif", str(i)))
+    assert [e.data for e in journal.drain()] == [b"3", b"4", b""]
+
+
+def test_drain_order(tmp_path):
+    journal = Journal(str(tmp_path / "journal.jsonl"))
+    journal.append("weather", b"", 2)
+    journal.append("media", b"", 1)
+    journal.append("notif1", b"", 0)
+    journal.append("notif2", b"", 0)
+    assert [e.uuid for e in journal.drain()] == \
+        ["notif1", "notif2", "media", "weather"]
+    assert len(journal) == 0
+
+
+def test_drain_empties_the_file(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = Journal(path)
+    journal.append("time", b"", 2)
+    journal.drain()
+    assert len(Journal(path)) == 0
+
+
+def test_compaction(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = Journal(str(path))
+    for i in range(100):
+        journal.append("title", str(i).encode(), 1)
+    assert len(path.read_text().splitlines()) <= 3
+    assert Journal(str(path)).drain()[0].data == b"99"
+
+
+def test_skips_corrupt_lines(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = Journal(str(path))
+    journal.append("time", b"", 2)
+    with path.open("a") as f:
+        f.write('{"uuid": "cut')
+    assert [e.uuid for e in Journal(str(path)).drain()] == ["time"]
+
+
+def test_bare_filename(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    journal = Journal("journal.jsonl")
+    journal.append("time", b"", 2)
+    assert (tmp_path / "journal.jsonl").exists()
@@ -0,0 +1,48 @@
+import pytest
+from asteroid import ATT_MAX_VALUE_LEN, encode_notification
+
+
+def test_fits_unchanged():
+    assert encode_notification("Summary", "Body", "1", None, "App", None) == \
+        b"<insert><su>Summary</su><bo>Body</bo><id>1</id>" \
+        b"<an>App</an></insert>"
+
+
+def test_escapes():
+    assert b"<su>a &amp; &lt;b&gt;</su>" in \
+        encode_notification("a & <b>", None, "1", None, None, None)
+
+
+def test_drops_optional_first():
+    data = encode_notification("s", "b", "1", "p" * 50, "a", "i" * 50, 80)
+    assert len(data) <= 80
+    assert b"<ai>" not in data and b"<pn>" not in data
+    assert b"<bo>b</bo>" in data
+
+
+@pytest.mark.parametrize("max_len", [17, 26, 40, 64, 100, 200,
+                                     ATT_MAX_VALUE_LEN])
+@pytest.mark.parametrize("args", [
+    ("s" * 600, "b" * 600, "1", "p" * 600, "a" * 600, "i" * 600),
+    ("s", None, "1", None, "A" * 600, None),
+    ("s", None, "1" * 600, None, None, None),
+    ("é&<" * 200, "\U0001f600" * 200, "12", None, "&" * 200, None),
+])
+def test_within_budget(args, max_len):
+    data = encode_notification(*args, max_len=max_len)
+    assert len(data) <= max_len
+    # Neither characters nor entities get split
+    text = data.decode()
+    for entity in text.split("&")[1:]:
+        assert entity.startswith(("amp;", "lt;", "gt;"))
+
+
+def test_truncates_with_ellipsis():
+    data = encode_notification("s", "x" * 100, "1", None, None, None, 60)
+    assert len(data) <= 60
+    assert "…</bo>" in data.decode()
+
+
+def test_budget_too_small():
+    with pytest.raises(ValueError):
+        encode_notification("s", None, "1", None, None, None, 10)
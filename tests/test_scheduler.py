@@ -0,0 +1,120 @@
+import pytest
+from asteroid.scheduler import QueueFull, WriteScheduler
+
+
+class Writer:
+    """ Records the writes, which complete once done() or fail() is called """
+
+    def __init__(self):
+        self.writes = []
+
+    def __call__(self, uuid, data, callback, error_callback):
+        self.writes.append((uuid, data, callback, error_callback))
+
+    def done(self):
+        self.writes[-1][2]()
+
+    def fail(self, error):
+        self.writes[-1][3](error)
+
+
+def written(writer):
+    return [(uuid, data) for uuid, data, _, _ in writer.writes]
+
+
+def test_one_write_in_flight():
+    writer = Writer()
+    sched = WriteScheduler(writer)
+    sched.submit("a", b"1", WriteScheduler.PRIORITY_NOTIFICATION)
+    sched.submit("b", b"2", WriteScheduler.PRIORITY_NOTIFICATION)
+    assert written(writer) == [("a", b"1")]
+    assert sched.depth == 1 and not sched.idle
+    writer.done()
+    assert written(writer) == [("a", b"1"), ("b", b"2")]
+    writer.done()
+    assert sched.idle
+
+
+def test_priority_order():
+    writer = Writer()
+    sched = WriteScheduler(writer)
+    sched.submit("first", b"", WriteScheduler.PRIORITY_WEATHER)
+    sched.submit("weather", b"", WriteScheduler.PRIORITY_WEATHER)
+    sched.submit("media", b"", WriteScheduler.PRIORITY_MEDIA)
+    sched.submit("notif", b"", WriteScheduler.PRIORITY_NOTIFICATION)
+    for _ in range(3):
+        writer.done()
+    assert [w[0] for w in written(writer)] == \
+        ["first", "notif", "media", "weather"]
+
+
+def test_merge_replaces_data_and_chains_callbacks():
+    writer = Writer()
+    sched = WriteScheduler(writer)
+    calls = []
+    sched.submit("busy", b"", 0)
+    sched.submit("a", b"old", 1, callback=lambda: calls.append("old"))
+    sched.submit("a", b"new", 1, callback=lambda: calls.append("new"))
+    assert sched.depth == 1
+    writer.done()
+    writer.done()
+    assert written(writer)[-1] == ("a", b"new")
+    assert calls == ["old", "new"]
+    assert sched.stats()["merged"] == 1
+
+
+def test_evicts_lower_priority():
+    writer = Writer()
+    sched = WriteScheduler(writer, max_depth=2)
+    errors = []
+    sched.submit("busy", b"", 0)
+    sched.submit("w1", b"", WriteScheduler.PRIORITY_WEATHER)
+    sched.submit("w2", b"", WriteScheduler.PRIORITY_WEATHER,
+                 error_callback=errors.append)
+    sched.submit("n", b"", WriteScheduler.PRIORITY_NOTIFICATION)
+    assert sched.depth == 2
+    assert len(errors) == 1 and isinstance(errors[0], QueueFull)
+    assert sched.stats()["evicted"] == 1
+
+
+def test_rejects_when_nothing_to_evict():
+    writer = Writer()
+    sched = WriteScheduler(writer, max_depth=1)
+    sched.submit("busy", b"", 0)
+    sched.submit("n1", b"", WriteScheduler.PRIORITY_NOTIFICATION)
+    assert sched.full
+    with pytest.raises(QueueFull):
+        sched.submit("w", b"", WriteScheduler.PRIORITY_WEATHER)
+    assert sched.stats()["rejected"] == 1
+
+
+def test_failure_moves_on():
+    writer = Writer()
+    sched = WriteScheduler(writer)
+    errors = []
+    sched.submit("a", b"", 0, error_callback=errors.append)
+    sched.submit("b", b"", 0)
+    error = IOError("gone")
+    writer.fail(error)
+    assert errors == [error]
+    assert written(writer)[-1] == ("b", b"")
+
+
+def test_writer_raising_fails_the_write():
+    errors = []
+    def writer(uuid, data, callback, error_callback):
+        raise IOError("no such characteristic")
+    sched = WriteScheduler(writer)
+    sched.submit("a", b"", 0, error_callback=errors.append)
+    assert len(errors) == 1 and sched.idle
+
+
+def test_clear():
+    writer = Writer()
+    sched = WriteScheduler(writer)
+    errors = []
+    sched.submit("a", b"", 0)
+    sched.submit("b", b"", 0, error_callback=errors.append)
+    sched.clear()
+    assert sched.depth == 0
+    assert len(errors) == 1 and isinstance(errors[0], QueueFull)
@@ -0,0 +1,47 @@
+import pytest
+from asteroid.timeseries import SampleRing
+
+
+def test_empty():
+    ring = SampleRing(4)
+    assert len(ring) == 0
+    assert ring.latest() is None
+    assert ring.slope() is None
+    assert list(ring) == []
+
+
+def test_wraparound():
+    ring = SampleRing(3)
+    for i in range(5):
+        ring.append(float(i), i * 10.0)
+    assert len(ring) == 3
+    assert list(ring) == [(2.0, 20.0), (3.0, 30.0), (4.0, 40.0)]
+    assert ring[0] == (2.0, 20.0)
+    assert ring[-1] == ring.latest() == (4.0, 40.0)
+    with pytest.raises(IndexError):
+        ring[3]
+
+
+def test_since():
+    ring = SampleRing(4)
+    for i in range(7):
+        ring.append(float(i), 0.0)
+    assert [t for t, _ in ring.since(4.5)] == [5.0, 6.0]
+    assert [t for t, _ in ring.since(0.0)] == [3.0, 4.0, 5.0, 6.0]
+    assert ring.since(10.0) == []
+
+
+def test_slope():
+    ring = SampleRing(8)
+    for i in range(12):
+        ring.append(100.0 + i, 50.0 - 2 * i)
+    assert ring.slope() == pytest.approx(-2.0)
+    assert ring.slope(since=109.0) == pytest.approx(-2.0)
+
+
+def test_slope_needs_distinct_times():
+    ring = SampleRing(4)
+    ring.append(1.0, 1.0)
+    assert ring.slope() is None
+    ring.append(1.0, 2.0)
+    assert ring.slope() is None